@@ -226,178 +226,2337 @@
 #     # If console shows garbled text on Windows, run: chcp 65001
 #     app.run(debug=True)
 #**********************************
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import (
+    Blueprint, Flask, abort, current_app, render_template, request, redirect, url_for, session, flash, g,
+    has_request_context, make_response, send_file, before_render_template, template_rendered
+)
+from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from flask_babel import Babel, gettext
+from flask_sqlalchemy.session import Session as FlaskSession
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import event, inspect, text, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import joinedload, make_transient_to_detached
+from werkzeug.http import is_resource_modified
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import check_password_hash, generate_password_hash, safe_join
+import click
+import flask_migrate
+from collections import Counter, OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta, timezone
+import csv
+import functools
+import gc
+import glob
+import hashlib
+import hmac
+import json
+import math
 import os
+import re
+import secrets
+import sys
+import threading
+import time
+import unicodedata
 
-app = Flask(__name__)
-app.secret_key = "secret_key_123"
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///maktabty.db'
-db = SQLAlchemy(app)
+def database_url(url):
+    # Hosting providers still hand out the postgres:// scheme SQLAlchemy dropped.
+    if url and url.startswith("postgres://"):
+        url = "postgresql://" + url[len("postgres://"):]
+    return url
+
+class Config:
+    SECRET_KEY = os.getenv('SECRET_KEY', "secret_key_123")
+    # Where sessions live: "database" (the web_session table), "redis"
+    # (SESSION_REDIS_URL, needs the redis package) or "cookie" (Flask's
+    # signed cookie). Server-side sessions end PERMANENT_SESSION_LIFETIME
+    # after their last write; the job worker deletes expired rows every
+    # SESSION_PURGE_SECONDS.
+    SESSION_STORE = "database"
+    SESSION_REDIS_URL = "redis://localhost:6379/0"
+    SESSION_PURGE_SECONDS = 3600
+    # SQLite by default; PostgreSQL via DATABASE_URL=postgresql://... (needs psycopg).
+    SQLALCHEMY_DATABASE_URI = database_url(os.getenv('DATABASE_URL', 'sqlite:///maktabty.db'))
+    # Optional read replica: read-only routes query it instead of the primary
+    # (see read_only()). A reader who just wrote stays on the primary for
+    # REPLICA_LAG_SECONDS so they see their own reservation.
+    SQLALCHEMY_BINDS = ({"replica": database_url(os.environ['DATABASE_REPLICA_URL'])}
+                        if os.getenv('DATABASE_REPLICA_URL') else {})
+    REPLICA_LAG_SECONDS = 5
+    # Set on every new SQLite connection. WAL lets /books keep reading while
+    # reserve() writes, and synchronous=NORMAL is safe in WAL mode (a power
+    # cut can only lose the last commits, never corrupt the file). An empty
+    # dict leaves SQLite's defaults alone.
+    SQLITE_PRAGMAS = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,          # ms a writer waits for the lock
+        "cache_size": -64000,          # negative = KiB, so ~64 MB
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    }
+    # Connection pool per engine (not used for in-memory SQLite); size it for
+    # the request threads of one worker process.
+    DB_POOL_SIZE = 10
+    DB_MAX_OVERFLOW = 20
+    BOOKS_PER_PAGE = 50
+    MAX_BOOKS_PER_PAGE = 200
+    # Cross-request cache of user rows for current_user(); size 0 turns it off.
+    USER_CACHE_SIZE = 1024
+    USER_CACHE_TTL = 60
+    # Memory budget for rendered anonymous catalog pages; 0 turns the cache off.
+    PAGE_CACHE_BYTES = 32 * 1024 * 1024
+    # /recs: neighbours kept per book by `flask train-recs`, how many of a
+    # reader's latest bookings seed their recommendations, and how many to show.
+    RECS_NEIGHBOURS = 20
+    RECS_HISTORY = 20
+    RECS_COUNT = 5
+    # New bookings are folded into the cooccurrence counts in the background
+    # and the touched books re-ranked at most this often.
+    RECS_LIVE_UPDATES = True
+    RECS_REFRESH_SECONDS = 60
+    # How often the job worker recounts Book.reserved from open bookings
+    # and repairs any drift; 0 turns it off.
+    AVAILABILITY_RECONCILE_SECONDS = 3600
+    # Background jobs (see enqueue()) run in `flask worker`. JOBS_IN_PROCESS
+    # runs the worker on a thread of the web process instead, for
+    # development or a single-process deployment. A claimed job is leased
+    # for JOB_LEASE_SECONDS; failures retry after JOB_RETRY_SECONDS,
+    # doubling each time, until JOB_MAX_ATTEMPTS.
+    JOBS_IN_PROCESS = False
+    JOB_BATCH_SIZE = 100
+    JOB_POLL_SECONDS = 1.0
+    JOB_LEASE_SECONDS = 300
+    JOB_RETRY_SECONDS = 10
+    JOB_MAX_ATTEMPTS = 5
+    # Per-request latency, SQL, template and size histograms at /metrics,
+    # plus an admin-only sampling profiler. Off by default; the numbers
+    # are per process.
+    METRICS_ENABLED = False
+    METRICS_PROFILE_INTERVAL = 0.005
+    # Werkzeug method for new password hashes, e.g. "scrypt:32768:8:1" or
+    # "pbkdf2:sha256:600000". Stored hashes made another way (and plaintext
+    # passwords from before hashing) are replaced at their owner's next
+    # login. The KDF runs on PASSWORD_HASH_WORKERS threads; logins past
+    # PASSWORD_HASH_QUEUE waiting for one get a 503 instead of queueing.
+    PASSWORD_HASH_METHOD = "scrypt:32768:8:1"
+    PASSWORD_HASH_WORKERS = 2
+    PASSWORD_HASH_QUEUE = 16
+    PASSWORD_HASH_TIMEOUT = 10
+    # Login and registration attempts, counted per client IP and (for
+    # logins) per username: LOGIN_BURST at once, then LOGIN_PER_MINUTE.
+    # Checked before any hashing; LOGIN_BURST = 0 turns the limit off, and
+    # LOGIN_PER_MINUTE = 0 gives each key its burst and no more.
+    LOGIN_BURST = 10
+    LOGIN_PER_MINUTE = 6
+    # Most books one batch reservation may ask for.
+    MAX_BATCH_RESERVATIONS = 50
+    # Static URLs carry a ?v= content fingerprint; such responses can be
+    # cached this long without revalidating.
+    STATIC_MAX_AGE = 365 * 24 * 3600
+    # Book covers: uploaded originals and their rendered thumbnails live in
+    # COVER_DIR (instance/covers by default); only these widths are served.
+    COVER_DIR = None
+    COVER_WIDTHS = (50, 100)
+    MAX_CONTENT_LENGTH = 10 * 1024 * 1024
+    # One template set for every language: text goes through gettext, the
+    # catalogs live in translations/ (see babel.cfg) and the layout takes
+    # its text direction from here. Compiled templates are kept in
+    # TEMPLATE_CACHE_DIR (instance/jinja-cache by default) so restarted
+    # workers skip recompiling them.
+    LANGUAGES = {"en": "ltr", "ar": "rtl"}
+    TEMPLATE_CACHE_DIR = None
+    # Reverse proxies in front of the app (nginx, a load balancer) whose
+    # X-Forwarded-For/-Proto/-Host headers are trusted. Without it every
+    # client shares the proxy's address, and with it the login limiter.
+    PROXY_FIX_HOPS = int(os.getenv('PROXY_FIX_HOPS', 0))
+    # Part of every page ETag, so pages cached before a deploy that changed
+    # the code, templates or translations stop validating. Defaults to a
+    # hash of those files' mtimes; set it (e.g. to the git commit) so every
+    # host of one release agrees.
+    BUILD_ID = os.getenv('BUILD_ID')
+
+class RoutingSession(FlaskSession):
+    """Sends the queries of read-only requests to the "replica" bind, when one
+    is configured; everything else, and any flush, goes to the primary."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and g and g.get('read_only'):
+            replica = db.engines.get("replica")
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+# Schema changes are Alembic migrations in migrations/ (`flask db migrate`,
+# `flask db upgrade`); BASELINE_REVISION is the schema from before them.
+def include_in_migrations(name, type_, parent_names):
+    # book_fts (and FTS5's shadow tables) are created by hand in the migrations.
+    return not (type_ == "table" and name.startswith("book_fts"))
+
+migrate = Migrate(directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations"),
+                  include_name=include_in_migrations)
+BASELINE_REVISION = "0001"
+babel = Babel()
+# Every route and CLI command lives on this blueprint; create_app() wires it
+# up, so importing the module never touches the database. cli_group=None
+# keeps the commands at the top level (`flask init-db`, not `flask main ...`).
+bp = Blueprint("main", __name__, cli_group=None)
+api = Blueprint("api", __name__, url_prefix="/api/v1")
 
 # --- MODELS ---
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
-    password = db.Column(db.String(80), nullable=False)
+    password = db.Column(db.String(255), nullable=False)  # see PasswordHasher
 
 class Book(db.Model):
+    __table_args__ = (db.Index('ix_book_title', 'title', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(150), nullable=False)
     author = db.Column(db.String(100))
-    copies = db.Column(db.Integer, default=1)
+    copies = db.Column(db.Integer, default=1)  # copies owned
+    image_filename = db.Column(db.String(64))  # original cover, see save_original()
+    # Open ("Reserved") bookings, changed only together with them.
+    reserved = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    @property
+    def available(self):
+        return max((self.copies or 0) - (self.reserved or 0), 0)
 
 class Booking(db.Model):
+    __table_args__ = (
+        db.Index('ix_booking_user_date', 'user_id', 'date'),
+        db.Index('ix_booking_book_status', 'book_id', 'status'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     book_id = db.Column(db.Integer, db.ForeignKey('book.id'))
     date = db.Column(db.DateTime, default=datetime.now)
     status = db.Column(db.String(20), default="Reserved")
+    book = db.relationship('Book')
+
+class BookNeighbor(db.Model):
+    """Precomputed top-K similar books, written by `flask train-recs`."""
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), primary_key=True)
+    neighbor_id = db.Column(db.Integer, db.ForeignKey('book.id'), primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+
+class BookCooccurrence(db.Model):
+    """Distinct readers who booked both books; (b, b) is b's own reader count."""
+    book_id = db.Column(db.Integer, primary_key=True)
+    other_id = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class CatalogVersion(db.Model):
+    """Single-row counter bumped by every write that changes the catalog pages."""
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    changed_at = db.Column(db.DateTime)  # UTC, sent as Last-Modified
+
+class StoredSession(db.Model):
+    """Server-side session data; see ServerSessionInterface."""
+    __tablename__ = "web_session"
+    id = db.Column(db.String(64), primary_key=True)  # SHA-256 of the cookie token
+    data = db.Column(db.LargeBinary, nullable=False)
+    expires = db.Column(db.DateTime, nullable=False, index=True)  # UTC
+
+class Job(db.Model):
+    """A queued side effect; see enqueue(). Finished jobs are deleted, failed
+    ones kept with their last error. While running, run_at is the lease end."""
+    __table_args__ = (db.Index('ix_job_due', 'status', 'run_at'),)
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default="{}")
+    status = db.Column(db.String(10), nullable=False, default="queued")  # queued, running, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_at = db.Column(db.DateTime, nullable=False)
+    last_error = db.Column(db.Text)
+
+# --- JOBS ---
+# Slow side effects run outside the request. A route calls enqueue() in the
+# transaction of its write, so a job exists exactly when the write
+# committed, and `flask worker` runs it later. A handler's own writes commit
+# together with the deletion of its job, so a job that fails half-way is
+# retried from scratch without applying anything twice.
+JOB_HANDLERS = {}
+
+def job_handler(name, batch=False):
+    """Register a job handler. A batch handler is called once with the
+    payloads of all claimed jobs of its name; others get one job's payload
+    as keyword arguments."""
+    def decorator(func):
+        JOB_HANDLERS[name] = (func, batch)
+        return func
+    return decorator
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def enqueue(name, delay=0, **payload):
+    """Queue a job in the current transaction, to run `delay` seconds after
+    it commits at the earliest."""
+    db.session.add(Job(name=name, payload=json.dumps(payload), run_at=utcnow() + timedelta(seconds=delay)))
+
+def claim_jobs(limit):
+    """Lease up to `limit` due jobs to this worker. A running job whose lease
+    ran out (its worker died) is due again."""
+    jobs = db.session.execute(claim_statement(limit)).all()
+    db.session.commit()
+    return jobs
+
+def claim_statement(limit):
+    now = utcnow()
+    due = (Job.status.in_(("queued", "running"))) & (Job.run_at <= now)
+    # ix_job_due already yields each status oldest first, so no ORDER BY.
+    # SKIP LOCKED lets PostgreSQL workers claim side by side; SQLite
+    # serialises the UPDATE anyway and ignores it.
+    candidates = db.select(Job.id).where(due).limit(limit).with_for_update(skip_locked=True)
+    return (update(Job).where(Job.id.in_(candidates), due)
+            .values(status="running", attempts=Job.attempts + 1,
+                    run_at=now + timedelta(seconds=current_app.config['JOB_LEASE_SECONDS']))
+            .returning(Job.id, Job.name, Job.payload, Job.attempts)
+            .execution_options(synchronize_session=False))
+
+def run_jobs(jobs):
+    by_name = {}
+    for job in jobs:
+        by_name.setdefault(job.name, []).append(job)
+    for name, group in by_name.items():
+        func, batch = JOB_HANDLERS.get(name, (None, False))
+        if batch and len(group) > 1:
+            try:
+                run_chunk(name, func, batch, group)
+                continue
+            except Exception:
+                db.session.rollback()
+                # One bad job must not sink the rest: find it by running
+                # the batch's jobs one at a time.
+                current_app.logger.warning("Batch of %d %s jobs failed; running them one by one",
+                                           len(group), name, exc_info=True)
+        for job in group:
+            try:
+                run_chunk(name, func, batch, [job])
+            except Exception as exc:
+                db.session.rollback()
+                current_app.logger.exception("Job %s failed", name)
+                retry_jobs([job], exc)
+
+def run_chunk(name, func, batch, chunk):
+    """Run `chunk` through its handler and delete its jobs, in one commit."""
+    if func is None:
+        raise LookupError(f"No handler for job {name!r}")
+    payloads = [json.loads(job.payload) for job in chunk]
+    if batch:
+        func(payloads)
+    else:
+        func(**payloads[0])
+    # Deleting by (id, attempts) fails if the lease ran out and another
+    # worker took the job over; then it owns the result.
+    finished = db.session.execute(
+        db.delete(Job).where(tuple_(Job.id, Job.attempts).in_([(j.id, j.attempts) for j in chunk]))
+        .execution_options(synchronize_session=False)).rowcount
+    if finished != len(chunk):
+        raise RuntimeError("Job lease expired while running")
+    db.session.commit()
+
+def retry_jobs(jobs, error):
+    config = current_app.config
+    for job in jobs:
+        if job.attempts >= config['JOB_MAX_ATTEMPTS']:
+            values = {"status": "failed"}
+        else:
+            delay = config['JOB_RETRY_SECONDS'] * 2 ** (job.attempts - 1)
+            values = {"status": "queued", "run_at": utcnow() + timedelta(seconds=delay)}
+        db.session.execute(update(Job).where(Job.id == job.id, Job.attempts == job.attempts)
+                           .values(last_error=repr(error)[:2000], **values)
+                           .execution_options(synchronize_session=False))
+    db.session.commit()
+
+def run_worker(app, stop=None, once=False):
+    """Claim and run jobs until `stop` is set (or, with `once`, until none are
+    due), reconciling availability every AVAILABILITY_RECONCILE_SECONDS and
+    deleting expired sessions every SESSION_PURGE_SECONDS."""
+    config = app.config
+    next_reconcile = time.monotonic() + config['AVAILABILITY_RECONCILE_SECONDS']
+    next_purge = time.monotonic()
+    while not (stop and stop.is_set()):
+        jobs = []
+        with app.app_context():
+            try:
+                jobs = claim_jobs(config['JOB_BATCH_SIZE'])
+                run_jobs(jobs)
+                if config['AVAILABILITY_RECONCILE_SECONDS'] and time.monotonic() >= next_reconcile:
+                    next_reconcile = time.monotonic() + config['AVAILABILITY_RECONCILE_SECONDS']
+                    fixed = reconcile_availability()
+                    if fixed:
+                        app.logger.warning("Repaired availability counters of %d books", fixed)
+                store = app.extensions.get("session_store")
+                if store and config['SESSION_PURGE_SECONDS'] and time.monotonic() >= next_purge:
+                    next_purge = time.monotonic() + config['SESSION_PURGE_SECONDS']
+                    store.purge()
+            except Exception:
+                db.session.rollback()
+                app.logger.exception("Job worker error")
+        if not jobs:
+            if once:
+                break
+            time.sleep(config['JOB_POLL_SECONDS'])
+
+class WorkerThread:
+    """run_worker() on a daemon thread of the web process, started by the
+    first request when JOBS_IN_PROCESS is set."""
+
+    def __init__(self, app):
+        self.app = app
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None or not self.app.config['JOBS_IN_PROCESS']:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=run_worker, args=(self.app,), name="job-worker", daemon=True)
+                self._thread.start()
+
+@bp.cli.command("worker")
+@click.option("--once", is_flag=True, help="Exit once no jobs are due instead of polling.")
+def worker_command(once):
+    """Run queued background jobs."""
+    run_worker(current_app._get_current_object(), once=once)
+
+# --- SEARCH ---
+# book_fts is a full-text index over Book.title/author keyed by rowid =
+# book.id: an FTS5 table on SQLite, a tsvector column with a GIN index on
+# PostgreSQL (both created in migration 0002). It stores normalized text (see normalize_search_text), so it is
+# kept in sync from Python via mapper events rather than SQL triggers.
+# Bulk/Core writes that bypass the ORM must call index_books() themselves.
+ARABIC_DIACRITICS = re.compile("[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]")
+ARABIC_LETTERS = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ى": "ي", "ة": "ه", "ؤ": "و", "ئ": "ي"})
+WORD = re.compile(r"\w+")
+
+def normalize_search_text(value):
+    """Fold case, strip Arabic tashkeel/tatweel, unify alef/yaa/taa marbuta
+    spellings and drop the leading "ال" article, so users find a title
+    however it was vowelled or spelled."""
+    value = unicodedata.normalize("NFKC", value or "").casefold()
+    value = ARABIC_DIACRITICS.sub("", value).translate(ARABIC_LETTERS)
+    words = []
+    for word in WORD.findall(value):
+        if word.startswith("ال") and len(word) > 3:
+            word = word[2:]
+        words.append(word)
+    return words
+
+def index_books(connection, books):
+    """Upsert (id, title, author) tuples into book_fts."""
+    rows = [{"id": id_, "title": " ".join(normalize_search_text(title)),
+             "author": " ".join(normalize_search_text(author))} for id_, title, author in books]
+    if not rows:
+        return
+    connection.execute(text("DELETE FROM book_fts WHERE rowid = :id"), rows)
+    if connection.dialect.name == "postgresql":
+        connection.execute(text(
+            "INSERT INTO book_fts (rowid, document) VALUES (:id, "
+            "setweight(to_tsvector('simple', :title), 'A') || setweight(to_tsvector('simple', :author), 'B'))"), rows)
+    else:
+        connection.execute(text("INSERT INTO book_fts(rowid, title, author) VALUES (:id, :title, :author)"), rows)
+
+def rebuild_search_index():
+    db.session.execute(text("DELETE FROM book_fts"))
+    index_books(db.session.connection(), db.session.query(Book.id, Book.title, Book.author))
+    # Search results may change, so cached search pages must revalidate.
+    bump_catalog_version()
+    db.session.commit()
+
+@event.listens_for(Book, "after_insert")
+def book_inserted(mapper, connection, book):
+    index_books(connection, [(book.id, book.title, book.author)])
+
+@event.listens_for(Book, "after_update")
+def book_updated(mapper, connection, book):
+    state = inspect(book)
+    if state.attrs.title.history.has_changes() or state.attrs.author.history.has_changes():
+        index_books(connection, [(book.id, book.title, book.author)])
+
+@event.listens_for(Book, "after_delete")
+def book_deleted(mapper, connection, book):
+    connection.execute(text("DELETE FROM book_fts WHERE rowid = :id"), {"id": book.id})
+
+def search_books(query, page, per_page):
+    """Return (books, has_next) for one ranked page of matches (bm25 on
+    SQLite, ts_rank on PostgreSQL; titles weigh more than authors)."""
+    words = normalize_search_text(query)
+    if not words:
+        return [], False
+    # Every word must match; the last one as a prefix so results show up while
+    # typing. A short word keeps its "ال", but the word being typed may become
+    # a longer one that is indexed without it, so its bare form counts too.
+    *whole, last = words
+    prefixes = [last, last[2:]] if last.startswith("ال") and len(last) > 2 else [last]
+    if db.engine.dialect.name == "postgresql":
+        sql = ("SELECT rowid FROM book_fts WHERE document @@ to_tsquery('simple', :match) "
+               "ORDER BY ts_rank(document, to_tsquery('simple', :match)) DESC LIMIT :limit OFFSET :offset")
+        match = " & ".join([*whole, "(%s)" % " | ".join(p + ":*" for p in prefixes)])
+    else:
+        sql = ("SELECT rowid FROM book_fts WHERE book_fts MATCH :match "
+               "ORDER BY bm25(book_fts, 10.0, 5.0) LIMIT :limit OFFSET :offset")
+        match = " AND ".join(['"%s"' % w for w in whole] + ["(%s)" % " OR ".join('"%s"*' % p for p in prefixes)])
+    ids = [row[0] for row in db.session.execute(
+        text(sql), {"match": match, "limit": per_page + 1, "offset": (page - 1) * per_page})]
+    has_next = len(ids) > per_page
+    ids = ids[:per_page]
+    by_id = {b.id: b for b in Book.query.filter(Book.id.in_(ids))} if ids else {}
+    return [by_id[i] for i in ids if i in by_id], has_next
 
 # --- DATABASE INIT ---
 def init_db():
-    with app.app_context():
-        db.create_all()
-        # Add some initial books if not exist
-        if not Book.query.first():
-            sample_books = [
-                Book(title="Python Programming", author="John Zelle", copies=5),
-                Book(title="Flask Web Development", author="Miguel Grinberg", copies=3),
-                Book(title="Data Science Handbook", author="Jake VanderPlas", copies=4)
-            ]
-            db.session.bulk_save_objects(sample_books)
-            db.session.commit()
-init_db()
+    """Bring the schema up to date by running the migrations. Run once per
+    deploy (`flask init-db`), never from request handling.
+
+    A database created before the migrations existed is stamped at the
+    baseline first, so its tables and data are kept.
+    """
+    tables = inspect(db.engine).get_table_names()
+    if "book" in tables and "alembic_version" not in tables:
+        flask_migrate.stamp(revision=BASELINE_REVISION)
+    flask_migrate.upgrade()
+    if Book.query.first() and not db.session.execute(text("SELECT 1 FROM book_fts LIMIT 1")).first():
+        rebuild_search_index()
+
+def seed_db():
+    # Add some initial books if not exist
+    if not Book.query.first():
+        sample_books = [
+            Book(title="Python Programming", author="John Zelle", copies=5),
+            Book(title="Flask Web Development", author="Miguel Grinberg", copies=3),
+            Book(title="Data Science Handbook", author="Jake VanderPlas", copies=4)
+        ]
+        db.session.bulk_save_objects(sample_books)
+        db.session.commit()
+    if not db.session.execute(text("SELECT 1 FROM book_fts LIMIT 1")).first() and Book.query.first():
+        rebuild_search_index()
+
+@bp.cli.command("init-db")
+def init_db_command():
+    """Create or upgrade the database schema."""
+    init_db()
+    print("Database initialized.")
+
+@bp.cli.command("seed")
+def seed_command():
+    """Add the sample books to an empty catalog."""
+    seed_db()
+    print("Sample data ready.")
+
+@bp.cli.command("reindex-search")
+def reindex_search_command():
+    """Rebuild the full-text search index from the book table."""
+    rebuild_search_index()
+    print("Search index rebuilt.")
+
+# --- RECOMMENDATIONS ---
+def insert_batches(model, rows, batch_size=10000):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            db.session.execute(db.insert(model), batch)
+            batch = []
+    if batch:
+        db.session.execute(db.insert(model), batch)
+
+def train_recommendations(k=None):
+    """Rebuild book_cooccurrence and book_neighbor from the booking history,
+    falling back to title/author similarity for books with too few bookings."""
+    import recommender  # scikit-learn is only needed offline
+    k = k or current_app.config['RECS_NEIGHBOURS']
+    bookings = db.session.execute(
+        db.select(Booking.id, Booking.user_id, Booking.book_id).where(Booking.book_id.isnot(None))).all()
+    item_ids, counts = recommender.cooccurrence((user_id, book_id) for _, user_id, book_id in bookings)
+    collaborative = recommender.item_neighbours(item_ids, counts, k)
+    content = recommender.content_neighbours(
+        db.session.execute(db.select(Book.id, Book.title, Book.author)), k, analyzer=normalize_search_text)
+    table = recommender.merge_neighbours(collaborative, content, k)
+    db.session.execute(db.delete(BookCooccurrence))
+    counts = counts.tocoo()
+    insert_batches(BookCooccurrence, ({"book_id": int(item_ids[i]), "other_id": int(item_ids[j]), "count": int(c)}
+                                      for i, j, c in zip(counts.row, counts.col, counts.data)))
+    db.session.execute(db.delete(BookNeighbor))
+    insert_batches(BookNeighbor, ({"book_id": book_id, "neighbor_id": n, "score": s}
+                                  for book_id, neighbours in table.items() for n, s in neighbours))
+    drop_counted_jobs({booking_id for booking_id, _, _ in bookings})
+    bump_catalog_version()
+    db.session.commit()
+    return len(table)
+
+def drop_counted_jobs(counted):
+    """Delete the record_bookings jobs whose bookings are all in `counted`,
+    so the worker doesn't add them on top of a retrain that already did. A
+    worker running one of them right now finds its job gone when it tries
+    to finish it, and rolls its increments back."""
+    stale = [job_id for job_id, payload in db.session.execute(
+                 db.select(Job.id, Job.payload).filter_by(name="record_bookings"))
+             if all(booking_id in counted for _, _, booking_id in json.loads(payload)["bookings"])]
+    for start in range(0, len(stale), 1000):
+        db.session.execute(db.delete(Job).where(Job.id.in_(stale[start:start + 1000]))
+                           .execution_options(synchronize_session=False))
+
+def record_cooccurrences(bookings):
+    """Fold new (user_id, book_id, booking_id) bookings into book_cooccurrence
+    and return the ids of the books whose neighbour lists are now stale.
+
+    Only the reader's earlier bookings are paired with each new one, so every
+    pair is counted once and re-reading a book counts nothing, the same
+    distinct-reader counts `flask train-recs` computes in bulk. The caller
+    commits, together with whatever marks the bookings as counted.
+    """
+    increments = Counter()
+    touched = set()
+    for user_id, book_id, booking_id in bookings:
+        earlier = set(db.session.execute(
+            db.select(Booking.book_id)
+            .where(Booking.user_id == user_id, Booking.id < booking_id, Booking.book_id.isnot(None))).scalars())
+        if book_id in earlier:
+            continue
+        increments[book_id, book_id] += 1
+        for other in earlier:
+            increments[book_id, other] += 1
+            increments[other, book_id] += 1
+        touched |= earlier | {book_id}
+    if increments:
+        # Sorted, so concurrent workers lock the rows in the same order.
+        db.session.execute(text(
+            "INSERT INTO book_cooccurrence (book_id, other_id, count) VALUES (:book_id, :other_id, :count) "
+            "ON CONFLICT (book_id, other_id) DO UPDATE SET count = book_cooccurrence.count + excluded.count"),
+            [{"book_id": b, "other_id": o, "count": c} for (b, o), c in sorted(increments.items())])
+    return touched
+
+def rerank_books(book_ids, k=None):
+    """Recompute the booking-based part of each book's top-K list from
+    book_cooccurrence, keeping its content-based filler rows. The caller
+    commits."""
+    k = k or current_app.config['RECS_NEIGHBOURS']
+    readers = db.aliased(BookCooccurrence)
+    for book_id in sorted(book_ids):
+        # Workers re-ranking the same book take turns on its own count row,
+        # so each replaces what the previous one wrote (SQLite needs no lock).
+        db.session.execute(db.select(BookCooccurrence.count)
+                           .filter_by(book_id=book_id, other_id=book_id).with_for_update())
+        rows = db.session.execute(
+            db.select(BookCooccurrence.other_id, BookCooccurrence.count, readers.count)
+            .join(readers, (readers.book_id == BookCooccurrence.other_id) & (readers.other_id == BookCooccurrence.other_id))
+            .where(BookCooccurrence.book_id == book_id)).all()
+        own = next((count for other, count, _ in rows if other == book_id), 0)
+        if not own:
+            continue
+        # Same cosine score as recommender.item_neighbours().
+        scored = sorted(((other, count / math.sqrt(own * other_readers))
+                         for other, count, other_readers in rows if other != book_id),
+                        key=lambda item: (-item[1], item[0]))[:k]
+        cooccurring = {other for other, _, _ in rows}
+        # At most k rows, so they are sorted here rather than in a temp B-tree.
+        filler = sorted(((n, s) for n, s in db.session.execute(
+            db.select(BookNeighbor.neighbor_id, BookNeighbor.score).where(BookNeighbor.book_id == book_id))
+            if n not in cooccurring), key=lambda item: -item[1])[:k - len(scored)]
+        db.session.execute(db.delete(BookNeighbor).where(BookNeighbor.book_id == book_id))
+        insert_batches(BookNeighbor, ({"book_id": book_id, "neighbor_id": n, "score": s} for n, s in scored + filler))
+    bump_catalog_version()
+
+# New bookings reach the recommendations through two jobs: record_bookings
+# folds them into book_cooccurrence right away, and rerank_books refreshes
+# the touched neighbour lists RECS_REFRESH_SECONDS later, so a burst of
+# bookings is re-ranked once.
+@job_handler("record_bookings", batch=True)
+def record_bookings_job(payloads):
+    touched = record_cooccurrences([tuple(b) for p in payloads for b in p["bookings"]])
+    if touched:
+        enqueue("rerank_books", delay=current_app.config['RECS_REFRESH_SECONDS'], book_ids=sorted(touched))
+
+@job_handler("rerank_books", batch=True)
+def rerank_books_job(payloads):
+    rerank_books(set().union(*(p["book_ids"] for p in payloads)))
+
+def recommend_books(user, limit):
+    """Sum the stored neighbour scores of the reader's recent bookings; readers
+    without history (or anonymous ones) get the newest books."""
+    ids = []
+    if user:
+        history = db.session.execute(
+            db.select(Booking.book_id).filter_by(user_id=user.id)
+            .order_by(Booking.date.desc()).limit(current_app.config['RECS_HISTORY'])).scalars().all()
+        scores = {}
+        if history:
+            booked = set(history)
+            rows = db.session.execute(db.select(BookNeighbor.neighbor_id, BookNeighbor.score)
+                                      .where(BookNeighbor.book_id.in_(booked)))
+            for neighbor_id, score in rows:
+                if neighbor_id not in booked:
+                    scores[neighbor_id] = scores.get(neighbor_id, 0.0) + score
+        ids = sorted(scores, key=lambda b: (-scores[b], b))[:limit]
+    if not ids:
+        return Book.query.order_by(Book.id.desc()).limit(limit).all()
+    by_id = {b.id: b for b in Book.query.filter(Book.id.in_(ids))}
+    return [by_id[i] for i in ids if i in by_id]
+
+@bp.cli.command("train-recs")
+@click.option("--k", type=int, default=None, help="Neighbours to keep per book.")
+def train_recs_command(k):
+    """Precompute the top-K neighbour table behind /recs."""
+    started = time.perf_counter()
+    count = train_recommendations(k)
+    print(f"Stored neighbours for {count} books in {time.perf_counter() - started:.1f}s.")
+
+# --- AVAILABILITY ---
+# Book.copies is the stock owned and Book.reserved the number of open
+# bookings. reserve() and return_book() change the counter in the same
+# transaction as the Booking row, so reading availability never counts
+# bookings; reconcile_availability() is the backstop for anything that
+# bypassed them (manual SQL, a crashed import, older releases).
+def reconcile_availability(batch_size=5000):
+    """Recount Book.reserved from open bookings, batch_size books at a time,
+    and return how many books had drifted.
+
+    Each batch reads the counter and the recount in one statement, and the
+    fix only applies if the counter is still what was read, so a reservation
+    that lands in between is never undone; it is picked up next run.
+    """
+    fixed = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(availability_batch(last_id, batch_size)).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        for book_id, reserved, actual in rows:
+            if reserved != actual:
+                fixed += db.session.execute(
+                    update(Book).where(Book.id == book_id, Book.reserved == reserved)
+                    .values(reserved=actual).execution_options(synchronize_session=False)).rowcount
+        db.session.commit()
+    if fixed:
+        bump_catalog_version()
+        db.session.commit()
+    return fixed
+
+def availability_batch(last_id, batch_size):
+    """(id, reserved, open bookings) of the next batch_size books after last_id."""
+    open_bookings = (db.select(db.func.count(Booking.id))
+                     .where(Booking.book_id == Book.id, Booking.status == "Reserved")
+                     .scalar_subquery())
+    return (db.select(Book.id, Book.reserved, open_bookings)
+            .where(Book.id > last_id).order_by(Book.id).limit(batch_size))
+
+@bp.cli.command("reconcile-availability")
+@click.option("--batch-size", default=5000, show_default=True, help="Books recounted per transaction.")
+def reconcile_availability_command(batch_size):
+    """Recount reserved copies from open bookings and fix any drift."""
+    fixed = reconcile_availability(batch_size)
+    print(f"Repaired {fixed} books.")
+
+# --- CATALOG IMPORT ---
+def read_catalog(path, fmt):
+    """Yield book dicts from a CSV (with a header row) or JSON Lines file one
+    record at a time. Records need a title; id, author and copies are optional,
+    and a record whose id already exists updates that book. Records that can't
+    be read (bad JSON, not an object, wrongly typed fields, a negative number
+    of copies) yield None."""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        records = csv.DictReader(f) if fmt == "csv" else (parse_jsonl(line) for line in f if line.strip())
+        for record in records:
+            try:
+                title = catalog_text(record.get("title"))
+                author = catalog_text(record.get("author"))
+                copies = int(record["copies"]) if record.get("copies") not in (None, "") else 1
+                book_id = int(record["id"]) if record.get("id") not in (None, "") else None
+            except (AttributeError, TypeError, ValueError):
+                yield None
+                continue
+            if not title or copies < 0:
+                yield None
+                continue
+            yield {"id": book_id, "title": title, "author": author, "copies": copies}
+
+def parse_jsonl(line):
+    """One JSON Lines record, or None (which read_catalog skips) if the line
+    isn't valid JSON."""
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+def catalog_text(value):
+    """A stripped title or author; numbers are taken as text, anything else
+    that isn't a string is a TypeError."""
+    if value is None:
+        return ""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        value = str(value)
+    if not isinstance(value, str):
+        raise TypeError(f"expected text, got {type(value).__name__}")
+    return value.strip()
+
+def upsert_books(rows):
+    """Insert or update a batch of book dicts with multi-row statements and
+    index them for search (the ORM events don't see Core statements)."""
+    postgresql = db.engine.dialect.name == "postgresql"
+    keyed = [row for row in rows if row["id"] is not None]
+    new = [{k: v for k, v in row.items() if k != "id"} for row in rows if row["id"] is None]
+    indexed = []
+    if keyed:
+        stmt = (postgresql_insert if postgresql else sqlite_insert)(Book)
+        stmt = stmt.on_conflict_do_update(index_elements=[Book.id], set_={
+            "title": stmt.excluded.title, "author": stmt.excluded.author, "copies": stmt.excluded.copies})
+        db.session.execute(stmt, keyed)
+        indexed += [(row["id"], row["title"], row["author"]) for row in keyed]
+        if postgresql:
+            # Explicit ids don't advance the serial sequence.
+            db.session.execute(text("SELECT setval(pg_get_serial_sequence('book', 'id'), (SELECT MAX(id) FROM book))"))
+    if new:
+        ids = db.session.execute(db.insert(Book).returning(Book.id, sort_by_parameter_order=True), new).scalars()
+        indexed += [(id_, row["title"], row["author"]) for id_, row in zip(ids, new)]
+    index_books(db.session.connection(), indexed)
+
+def import_catalog(path, fmt, batch_size=5000, report=print):
+    """Stream a catalog file into the book table, committing every batch_size
+    rows. Returns (imported, skipped)."""
+    imported = skipped = 0
+    started = time.perf_counter()
+    batch = []
+
+    def flush():
+        upsert_books(batch)
+        bump_catalog_version()
+        db.session.commit()
+        batch.clear()
+        elapsed = time.perf_counter() - started
+        report(f"{imported} books imported, {skipped} skipped ({imported / elapsed:.0f} rows/s)")
+
+    for row in read_catalog(path, fmt):
+        if row is None:
+            skipped += 1
+            continue
+        batch.append(row)
+        imported += 1
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return imported, skipped
+
+@bp.cli.command("import-catalog")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]), default=None,
+              help="File format; guessed from the extension by default.")
+@click.option("--batch-size", type=int, default=5000, show_default=True, help="Rows per transaction.")
+def import_catalog_command(path, fmt, batch_size):
+    """Bulk-load books from a CSV or JSON Lines file."""
+    fmt = fmt or ("jsonl" if path.lower().endswith((".jsonl", ".ndjson", ".json")) else "csv")
+    started = time.perf_counter()
+    imported, skipped = import_catalog(path, fmt, batch_size)
+    elapsed = time.perf_counter() - started
+    print(f"Done: {imported} books imported, {skipped} skipped in {elapsed:.1f}s.")
 
 # --- HELPER ---
+class LRUCache:
+    """Thread-safe LRU mapping whose entries expire `ttl` seconds after being set.
+
+    `maxsize` bounds the total `sizeof(value)` of the entries, which by
+    default counts every entry as 1.
+    """
+
+    def __init__(self, maxsize, ttl=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires, size = item
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                self.size -= size
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        if size > self.maxsize:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self._data[key] = (value, expires, size)
+            self.size += size
+            while self.size > self.maxsize:
+                _, (_, _, evicted) = self._data.popitem(last=False)
+                self.size -= evicted
+
+    def pop(self, key):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+# app.extensions["user_cache"] holds the column values of recently seen
+# users, keyed by id. Rows are rebuilt from these and merged into the
+# session, so a hit issues no SQL at all.
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def forget_user(mapper, connection, user):
+    current_app.extensions["user_cache"].pop(user.id)
+
+def load_user(uid):
+    user_cache = current_app.extensions["user_cache"]
+    values = user_cache.get(uid)
+    if values is not None:
+        user = User(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+    user = db.session.get(User, uid)
+    if user is not None:
+        user_cache.set(uid, {c.key: getattr(user, c.key) for c in User.__table__.columns})
+    return user
+
 def current_user():
-    uid = session.get('user_id')
-    if uid:
-        return User.query.get(uid)
-    return None
+    """The logged-in User, looked up at most once per request."""
+    if '_current_user' not in g:
+        uid = session.get('user_id')
+        g._current_user = load_user(uid) if uid else None
+    return g._current_user
 
 def get_language():
     return session.get('lang', 'en')
 
+@bp.app_context_processor
+def language_context():
+    # For <html lang dir> in the layout.
+    lang = get_language()
+    return {"lang": lang, "rtl": current_app.config['LANGUAGES'].get(lang) == "rtl"}
+
+def catalog_state():
+    """(version, changed_at) of the catalog, read at most once per request."""
+    if 'catalog_state' not in g:
+        g.catalog_state = db.session.execute(
+            db.select(CatalogVersion.version, CatalogVersion.changed_at).filter_by(id=1)).first() or (0, None)
+    return g.catalog_state
+
+def catalog_version():
+    return catalog_state()[0]
+
+def bump_catalog_version():
+    """Invalidate cached catalog pages; call inside the writing transaction."""
+    db.session.execute(update(CatalogVersion).where(CatalogVersion.id == 1)
+                       .values(version=CatalogVersion.version + 1,
+                               changed_at=datetime.now(timezone.utc).replace(tzinfo=None)))
+    g.pop('catalog_state', None)
+
+def read_only(view):
+    """Mark a route that never writes, so its queries may go to the replica."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_only = session.get('primary_until', 0) < time.time()
+        return view(*args, **kwargs)
+    return wrapper
+
+@event.listens_for(RoutingSession, "after_commit")
+def remember_write(db_session):
+    if g:
+        g.wrote = True
+
+def cached_page(view):
+    """Serve the view from page_cache for anonymous visitors.
+
+    Logged-in pages show the username and flashes are one-shot, so those
+    requests always render.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if 'user_id' in session or '_flashes' in session:
+            return view(*args, **kwargs)
+        # Entries for an old catalog version are simply never hit again and
+        # age out of the LRU.
+        page_cache = current_app.extensions["page_cache"]
+        key = (request.endpoint, get_language(), catalog_version(), request.query_string)
+        html = page_cache.get(key)
+        if html is None:
+            html = view(*args, **kwargs)
+            if isinstance(html, str):
+                page_cache.set(key, html)
+        return html
+    return wrapper
+
+def conditional_get(personal=True):
+    """Validate a catalog page against the catalog version and BUILD_ID before
+    running the view: a matching If-None-Match gets a bare 304. Other
+    responses get an ETag and Cache-Control: no-cache, so clients always
+    revalidate but rarely download.
+
+    Personal pages also depend on the visitor's language and login, which
+    are part of their ETag, and are marked private for shared caches. A
+    date can't tell two visitors apart, so only public pages send (and
+    honour) Last-Modified.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if '_flashes' in session:
+                return view(*args, **kwargs)
+            version, changed_at = catalog_state()
+            key = f"{current_app.config['BUILD_ID']} {version} {request.full_path}"
+            if personal:
+                key += f" {get_language()} {session.get('user_id')}"
+                changed_at = None
+            g.catalog_etag = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+            if is_resource_modified(request.environ, etag=g.catalog_etag, last_modified=changed_at):
+                response = make_response(view(*args, **kwargs))
+            else:
+                response = current_app.response_class(status=304)
+            if response.status_code in (200, 304):
+                response.set_etag(g.catalog_etag)
+                response.cache_control.no_cache = True
+                if personal:
+                    response.cache_control.private = True
+                else:
+                    response.last_modified = changed_at
+                    response.cache_control.public = True
+            return response
+        return wrapper
+    return decorator
+
+def build_id(app):
+    """A fingerprint of the deployed code, templates and translation catalogs,
+    from their mtimes (stat only, so create_app stays cheap)."""
+    paths = [__file__,
+             *glob.glob(os.path.join(app.root_path, app.template_folder, "**", "*.html"), recursive=True),
+             *glob.glob(os.path.join(app.root_path, "translations", "*", "LC_MESSAGES", "*.mo"))]
+    stamp = " ".join(f"{os.path.relpath(p, app.root_path)}:{os.stat(p).st_mtime_ns}" for p in sorted(paths))
+    return hashlib.blake2b(stamp.encode(), digest_size=8).hexdigest()
+
+@functools.lru_cache(maxsize=256)
+def file_fingerprint(path, mtime_ns):
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "md5").hexdigest()[:12]
+
+def static_fingerprint(filename):
+    """Content hash of a file under static/, or None if there is no such file."""
+    path = safe_join(current_app.static_folder, filename)
+    try:
+        return file_fingerprint(path, os.stat(path).st_mtime_ns)
+    except (TypeError, OSError):
+        return None
+
+# One page of a keyset (cursor) listing: next_cursor / prev_cursor are the
+# ids to pass back as ?after= / ?before=, or None at either end.
+Page = namedtuple("Page", ["items", "per_page", "next_cursor", "prev_cursor"])
+
+def get_per_page():
+    per_page = request.args.get('per_page', current_app.config['BOOKS_PER_PAGE'], type=int)
+    return max(1, min(per_page, current_app.config['MAX_BOOKS_PER_PAGE']))
+
+def keyset_page(query, columns, per_page, cursor_values=None, descending=False, bounds=None):
+    """Fetch one page of `query` ordered by `columns`, the last of which must
+    be the row's unique id.
+
+    Seeks with WHERE (columns) > cursor (or < for ?before) instead of OFFSET,
+    so the cost of a page does not grow with how deep into the table it is.
+    The ?after= / ?before= cursors are row ids; cursor_values(id) returns that
+    row's values for `columns`, or None if it is not part of this listing.
+
+    A listing limited to a range of its first column passes it as
+    bounds=(low, high), meaning low <= column < high, rather than filtering
+    `query` itself. The side the page seeks from then starts at the cursor,
+    because SQLite bounds its index seek by one condition per side and
+    would otherwise walk from the start of the range to the cursor.
+    """
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    cursor_id = before if before is not None else after
+    cursor = None
+    if cursor_id is not None:
+        cursor = cursor_values(cursor_id) if cursor_values else (cursor_id,)
+    if bounds is not None:
+        low, high = bounds
+        lead = columns[0]
+        if cursor is None:
+            query = query.filter(lead >= low, lead < high)
+        elif (before is None) != descending:  # seeking towards higher values
+            query = query.filter(lead >= cursor[0], lead < high)
+        else:
+            query = query.filter(lead >= low, lead <= cursor[0])
+    key = tuple_(*columns)
+    forward = [c.desc() if descending else c.asc() for c in columns]
+    backward = [c.asc() if descending else c.desc() for c in columns]
+    if cursor is not None and before is not None:
+        earlier = key > tuple_(*cursor) if descending else key < tuple_(*cursor)
+        rows = query.filter(earlier).order_by(*backward).limit(per_page + 1).all()
+        has_prev = len(rows) > per_page
+        rows = rows[:per_page][::-1]
+        has_next = True
+    else:
+        if cursor is not None:
+            query = query.filter(key < tuple_(*cursor) if descending else key > tuple_(*cursor))
+        rows = query.order_by(*forward).limit(per_page + 1).all()
+        has_next = len(rows) > per_page
+        rows = rows[:per_page]
+        has_prev = cursor is not None
+    next_cursor = rows[-1].id if rows and has_next else None
+    prev_cursor = rows[0].id if rows and has_prev else None
+    return Page(rows, per_page, next_cursor, prev_cursor)
+
+def booking_page(user_id, per_page):
+    """Newest-first page of a user's bookings with their books joined in,
+    seeking on (date, id) so it walks ix_booking_user_date instead of sorting."""
+    def cursor_values(booking_id):
+        return db.session.execute(db.select(Booking.date, Booking.id)
+                                  .filter_by(id=booking_id, user_id=user_id)).first()
+    query = Booking.query.options(joinedload(Booking.book)).filter(Booking.user_id == user_id)
+    return keyset_page(query, (Booking.date, Booking.id), per_page, cursor_values, descending=True)
+
+def title_range(prefix):
+    """(low, high) of the titles starting with `prefix`, a range ix_book_title
+    can seek (LIKE 'x%' can't use a plain index on SQLite)."""
+    return prefix, prefix + "\U0010ffff"
+
+def title_cursor(prefix):
+    low, high = title_range(prefix)
+    def cursor_values(book_id):
+        return db.session.execute(db.select(Book.title, Book.id)
+                                  .filter(Book.id == book_id, Book.title >= low, Book.title < high)).first()
+    return cursor_values
+
+def book_page():
+    """The /books listing for the current request: every book by id, or with
+    ?starts= the books whose title has that prefix, by title."""
+    starts = request.args.get('starts', '').strip()
+    if starts:
+        page = keyset_page(Book.query, (Book.title, Book.id), get_per_page(), title_cursor(starts),
+                           bounds=title_range(starts))
+    else:
+        page = keyset_page(Book.query, (Book.id,), get_per_page())
+    return page, starts
+
+def reserve_copy(user_id, book_id):
+    """Reserve a copy of the book for the user; returns the new booking's id,
+    or None if no copy is free."""
+    return reserve_copies(user_id, [book_id])[0]
+
+def reserve_copies(user_id, book_ids):
+    """Reserve a copy of each listed book (a repeated id asks for another
+    copy) in one transaction. Returns the new booking ids in the order asked,
+    with None where no copy was free; the others are still reserved."""
+    wanted = Counter(book_ids)
+    if wanted and db.engine.dialect.name == "postgresql":
+        # Lock the rows in id order so overlapping batches queue instead of
+        # deadlocking. SQLite locks the whole database on the first write.
+        db.session.execute(db.select(Book.id).where(Book.id.in_(wanted)).order_by(Book.id).with_for_update())
+    # Claim copies with conditional UPDATEs so concurrent reservations can
+    # never oversell: one statement per round, a round per repeated id.
+    claimed = Counter()
+    for round_ in range(max(wanted.values(), default=0)):
+        ids = [b for b, n in wanted.items() if n > round_ and claimed[b] == round_]
+        if not ids:
+            break
+        claimed.update(db.session.execute(
+            update(Book).where(Book.id.in_(ids), Book.reserved < Book.copies)
+            .values(reserved=Book.reserved + 1).returning(Book.id)
+            .execution_options(synchronize_session=False)).scalars())
+    granted = []
+    for book_id in book_ids:
+        granted.append(claimed[book_id] > 0)
+        claimed[book_id] -= 1
+    rows = [{"user_id": user_id, "book_id": b} for b, ok in zip(book_ids, granted) if ok]
+    if not rows:
+        db.session.rollback()
+        return [None] * len(book_ids)
+    new_ids = iter(db.session.execute(
+        db.insert(Booking).returning(Booking.id, sort_by_parameter_order=True), rows).scalars().all())
+    booking_ids = [next(new_ids) if ok else None for ok in granted]
+    bump_catalog_version()
+    if current_app.config['RECS_LIVE_UPDATES']:
+        enqueue("record_bookings", bookings=[[user_id, book_id, booking_id]
+                                             for book_id, booking_id in zip(book_ids, booking_ids) if booking_id])
+    db.session.commit()
+    return booking_ids
+
+def return_booking(user_id, booking_id):
+    """Close the user's open booking and release its copy; False if there is
+    no such open booking."""
+    # Closing the booking is conditional on it still being open, so a double
+    # submit releases the copy only once.
+    book_id = db.session.execute(
+        update(Booking).where(Booking.id == booking_id, Booking.user_id == user_id, Booking.status == "Reserved")
+        .values(status="Returned").returning(Booking.book_id)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    if book_id is None:
+        db.session.rollback()
+        return False
+    db.session.execute(
+        update(Book).where(Book.id == book_id, Book.reserved > 0)
+        .values(reserved=Book.reserved - 1)
+        .execution_options(synchronize_session=False))
+    bump_catalog_version()
+    db.session.commit()
+    return True
+
+# --- SESSIONS ---
+# With a server-side SESSION_STORE the cookie holds only a random token. The
+# store keeps the session under the token's SHA-256, so a copy of the store
+# holds no usable cookies. Data is Flask's tagged JSON, the same encoding
+# the signed cookie used, fetched on first use and written back only when it
+# changed.
+def session_key(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+class DatabaseSessionStore:
+    """Sessions in the web_session table of the primary database. Uses its
+    own connections: a session is saved even when the request's transaction
+    was rolled back, and never read from a lagging replica."""
+
+    def load(self, key):
+        with db.engine.connect() as conn:
+            return conn.execute(db.select(StoredSession.data, StoredSession.expires).where(
+                StoredSession.id == key, StoredSession.expires > utcnow())).first()
+
+    def save(self, key, data, expires):
+        postgresql = db.engine.dialect.name == "postgresql"
+        stmt = (postgresql_insert if postgresql else sqlite_insert)(StoredSession).values(
+            id=key, data=data, expires=expires)
+        stmt = stmt.on_conflict_do_update(index_elements=[StoredSession.id], set_={
+            "data": stmt.excluded.data, "expires": stmt.excluded.expires})
+        with db.engine.begin() as conn:
+            conn.execute(stmt)
+
+    def delete(self, key):
+        with db.engine.begin() as conn:
+            conn.execute(db.delete(StoredSession).where(StoredSession.id == key))
+
+    def purge(self):
+        with db.engine.begin() as conn:
+            return conn.execute(db.delete(StoredSession).where(StoredSession.expires <= utcnow())).rowcount
+
+class RedisSessionStore:
+    """Sessions in Redis, or any server speaking its protocol; keys expire
+    on their own."""
+
+    def __init__(self, url):
+        import redis  # only needed for SESSION_STORE = "redis"
+        self.redis = redis.Redis.from_url(url)
+
+    def load(self, key):
+        data, ttl = self.redis.pipeline().get(f"session:{key}").pttl(f"session:{key}").execute()
+        if data is None:
+            return None
+        return data, utcnow() + timedelta(milliseconds=max(ttl, 0))
+
+    def save(self, key, data, expires):
+        self.redis.set(f"session:{key}", data, px=max(1, int((expires - utcnow()).total_seconds() * 1000)))
+
+    def delete(self, key):
+        self.redis.delete(f"session:{key}")
+
+    def purge(self):
+        return 0
+
+class ServerSession(SessionMixin):
+    """A session whose data is read from the store on first access and
+    that tracks its own changes, so untouched sessions cost no I/O."""
+
+    def __init__(self, store, token=None):
+        self.store = store
+        self.token = token
+        self.new = token is None
+        self.modified = False
+        self.rotated = False
+        self.expires = None  # set once loaded, if the store knows the token
+        self._data = None
+
+    def _load(self):
+        if self._data is None:
+            stored = self.store.load(session_key(self.token)) if self.token else None
+            self._data = session_json_serializer.loads(stored[0].decode()) if stored else {}
+            self.expires = stored[1] if stored else None
+        return self._data
+
+    def rotate(self):
+        """Keep the data under a fresh token, so a token planted before a
+        login is worthless after it."""
+        self._load()
+        self.rotated = self.modified = True
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self._load()[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        return ServerSession(self.store, request.cookies.get(self.get_cookie_name(app)) or None)
+
+    def save_session(self, app, session, response):
+        if session.accessed:
+            response.vary.add("Cookie")
+        lifetime = app.permanent_session_lifetime
+        # A cookie the store doesn't know (expired, or never issued) is
+        # dropped, and an unchanged session is rewritten only to push back
+        # its expiry once less than half of its lifetime is left.
+        unknown = session.token and session._data is not None and session.expires is None
+        if not (session.modified or unknown or (session.expires and session.expires - utcnow() < lifetime / 2)):
+            return
+        cookie = dict(domain=self.get_cookie_domain(app), path=self.get_cookie_path(app),
+                      secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app),
+                      httponly=self.get_cookie_httponly(app))
+        token = session.token if session.expires else None
+        if token and (session.rotated or not session):
+            self.store.delete(session_key(token))
+            token = None
+        if not session:
+            if session.token:
+                response.delete_cookie(self.get_cookie_name(app), **cookie)
+            return
+        if token is None:
+            token = secrets.token_urlsafe(32)
+        self.store.save(session_key(token), session_json_serializer.dumps(dict(session)).encode(), utcnow() + lifetime)
+        if token != session.token or session.permanent:
+            response.set_cookie(self.get_cookie_name(app), token,
+                                expires=self.get_expiration_time(app, session), **cookie)
+
+def rotate_session():
+    if isinstance(session, ServerSession):
+        session.rotate()
+
+# --- PASSWORDS ---
+# Matches what generate_password_hash() returns: method$salt$hex digest.
+PASSWORD_HASH = re.compile(r"^(?:scrypt|pbkdf2)(?::[\w:]+)?\$[^$]+\$[0-9a-f]+$")
+
+class PasswordHasherBusy(Exception):
+    """Too many logins are already waiting for the KDF."""
+
+class PasswordHasher:
+    """Hashes and checks passwords on a small thread pool, so a burst of
+    logins keeps at most `workers` cores busy instead of every request
+    thread. Once `max_waiting` calls are queued behind them, more raise
+    PasswordHasherBusy rather than piling up."""
+
+    def __init__(self, method, workers, max_waiting, timeout):
+        self.method = method
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self._slots = threading.BoundedSemaphore(workers + max_waiting)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except FutureTimeoutError:
+            raise PasswordHasherBusy() from None
+
+    @functools.cached_property
+    def _current(self):
+        # A hash made now, for its spelled-out method ("scrypt" is stored as
+        # "scrypt:32768:8:1") and to check unknown usernames against.
+        return self._run(generate_password_hash, "", self.method)
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, stored, password):
+        """Check `password` against a stored hash, a legacy plaintext
+        password or, for an unknown user, None. Returns (ok, new_hash);
+        new_hash is set when the stored value should be replaced."""
+        if stored is None:
+            # Cost the same as a real check, so timing doesn't reveal usernames.
+            self._run(check_password_hash, self._current, password)
+            return False, None
+        if not PASSWORD_HASH.match(stored):
+            if not hmac.compare_digest(stored.encode(), password.encode()):
+                return False, None
+            return True, self.hash(password)
+        if not self._run(check_password_hash, stored, password):
+            return False, None
+        if stored.split("$", 1)[0] != self._current.split("$", 1)[0]:
+            return True, self.hash(password)
+        return True, None
+
+class TokenBuckets:
+    """Per-key token buckets: a key may spend `burst` tokens at once and
+    earns them back at `rate` per second (never, at rate 0). Only the
+    `maxkeys` most recently used keys are remembered; a forgotten key starts
+    again with a full bucket."""
+
+    # What take() reports when the rate is 0 and a key is out of tokens.
+    NO_REFILL_WAIT = 24 * 3600
+
+    def __init__(self, burst, rate, maxkeys=100_000):
+        self.burst = burst
+        self.rate = rate
+        self.maxkeys = maxkeys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """Spend one of `key`'s tokens. Returns 0 if there was one, else the
+        seconds until there will be."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, stamp = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            if tokens >= 1:
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate if self.rate else self.NO_REFILL_WAIT
+            self._buckets[key] = (tokens - 1 if not wait else tokens, now)
+            while len(self._buckets) > self.maxkeys:
+                self._buckets.popitem(last=False)
+        return wait
+
+def login_throttled(username=None):
+    """Spend an attempt for the client IP and, if given, `username`. Returns
+    the seconds to wait when either has none left, else 0."""
+    limiter = current_app.extensions["login_limiter"]
+    if limiter is None:
+        return 0
+    wait = limiter.take(("ip", request.remote_addr))
+    if not wait and username:
+        wait = limiter.take(("user", username))
+    return wait
+
+def check_login(username, password):
+    """The User with these credentials, or None. Upgrades the stored hash
+    when it was made with other parameters than PASSWORD_HASH_METHOD."""
+    user = User.query.filter_by(username=username).first()
+    ok, new_hash = current_app.extensions["password_hasher"].verify(
+        user.password if user else None, password or "")
+    if not ok:
+        return None
+    if new_hash:
+        user.password = new_hash
+        db.session.commit()
+    return user
+
+def retry_after(response, seconds):
+    response.headers["Retry-After"] = str(max(1, math.ceil(seconds)))
+    return response
+
+# --- COVERS ---
+# Covers are stored under a hash of their content, so a thumbnail URL names
+# one exact picture forever and is served as immutable. Thumbnails are
+# rendered by covers.py on first request, or ahead of time by
+# `flask build-covers`, into COVER_DIR/thumbs.
+def cover_dir():
+    return current_app.config['COVER_DIR'] or os.path.join(current_app.instance_path, "covers")
+
+@bp.app_template_global()
+def cover_url(book, width, fmt):
+    if not book.image_filename:
+        return None
+    return url_for('main.cover', name=book.image_filename.split(".")[0], width=width, fmt=fmt)
+
+def cover_thumbnail(name, width, fmt):
+    """Path of a rendered thumbnail, rendering it if needed; None if there is
+    no original by that name."""
+    target = os.path.join(cover_dir(), "thumbs", f"{name}-{width}.{fmt}")
+    if not os.path.exists(target):
+        originals = glob.glob(os.path.join(cover_dir(), glob.escape(name) + ".*"))
+        if not originals:
+            return None
+        import covers  # Pillow is only needed for cover images
+        covers.render_thumbnail(originals[0], target, width, fmt)
+    return target
+
+@bp.route("/covers/<name>-<int:width>.<fmt>")
+def cover(name, width, fmt):
+    if (width not in current_app.config['COVER_WIDTHS'] or fmt not in ("webp", "jpeg")
+            or not re.fullmatch(r"[0-9a-f]{16}", name)):
+        abort(404)
+    path = cover_thumbnail(name, width, fmt)
+    if path is None:
+        abort(404)
+    response = send_file(path, mimetype=f"image/{fmt}", max_age=current_app.config['STATIC_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@job_handler("render_cover")
+def render_cover_job(image_filename):
+    for width in current_app.config['COVER_WIDTHS']:
+        for fmt in ("webp", "jpeg"):
+            cover_thumbnail(image_filename.split(".")[0], width, fmt)
+
+@bp.cli.command("build-covers")
+def build_covers_command():
+    """Render every cover thumbnail that is not on disk yet."""
+    names = db.session.execute(db.select(Book.image_filename).distinct()
+                               .where(Book.image_filename.isnot(None))).scalars().all()
+    missing = [name for name in names
+               if not all(cover_thumbnail(name.split(".")[0], width, fmt)
+                          for width in current_app.config['COVER_WIDTHS'] for fmt in ("webp", "jpeg"))]
+    print(f"Covers ready: {len(names) - len(missing)}.")
+    if missing:
+        print(f"Originals missing: {', '.join(missing)}")
+
+# --- QUERY PLANS ---
+def hot_queries():
+    """The busiest pages and jobs, each as a call into the same helper the
+    route or worker uses, with sample parameters taken from the database.
+    Pages get a ?after= cursor so their keyset predicate is checked too.
+    The reader for /recs is one whose books have neighbours; until
+    `flask train-recs` has run there is none and that check is left out."""
+    latest = db.select(Booking.user_id, Booking.id, Booking.book_id).where(Booking.book_id.isnot(None))
+    user_id, booking_id, book_id = db.session.execute(
+        latest.order_by(Booking.id.desc()).limit(1)).first() or (1, 1, 1)
+    queries = {
+        "books page": in_request(book_page, after=book_id),
+        "books by title prefix": in_request(book_page, starts="P", after=book_id),
+        "my bookings": in_request(lambda: booking_page(user_id, get_per_page()), after=booking_id),
+        "login": lambda: check_login("admin", secrets.token_hex(8)),
+        "record bookings": lambda: record_cooccurrences([(user_id, book_id, booking_id)]),
+        "rerank books": lambda: rerank_books({book_id}),
+        "availability recount": functools.partial(db.session.execute, availability_batch(0, 5000)),
+        "due jobs": functools.partial(db.session.execute, claim_statement(100)),
+    }
+    reader = db.session.execute(
+        latest.where(Booking.book_id.in_(db.select(BookNeighbor.book_id))).limit(1)).first()
+    if reader:
+        user = db.session.get(User, reader.user_id)
+        queries["recs for a reader"] = lambda: recommend_books(user, current_app.config['RECS_COUNT'])
+    return queries
+
+def in_request(func, **args):
+    """Call func() inside a request whose query string is `args`."""
+    def call():
+        with current_app.test_request_context(query_string=args):
+            return func()
+    return call
+
+def keyset_samples():
+    """(first page, page at the far end) of each keyset listing. A seek that
+    starts at its cursor does about the same work for both; one that walks
+    from the start of the listing to the cursor does far more for the last."""
+    samples = {}
+    last_book = db.session.execute(
+        db.select(Book.id, Book.title).order_by(Book.title.desc(), Book.id.desc()).limit(1)).first()
+    if last_book:
+        samples["books page"] = (in_request(book_page), in_request(book_page, after=db.session.scalar(
+            db.select(db.func.max(Book.id)))))
+        starts = last_book.title[:1]
+        samples["books by title prefix"] = (in_request(book_page, starts=starts),
+                                            in_request(book_page, starts=starts, after=last_book.id))
+    oldest = db.session.execute(
+        db.select(Booking.user_id, Booking.id).order_by(Booking.date, Booking.id).limit(1)).first()
+    if oldest:
+        samples["my bookings"] = (in_request(lambda: booking_page(oldest.user_id, get_per_page())),
+                                  in_request(lambda: booking_page(oldest.user_id, get_per_page()), after=oldest.id))
+    return samples
+
+def sent_statements(run):
+    """Call `run` in a savepoint that is rolled back afterwards, and return
+    the exact SQL and parameters of each statement it sent."""
+    sent = []
+    def capture(conn, cursor, sql, parameters, context, executemany):
+        if not sql.lstrip().upper().startswith(("SAVEPOINT", "RELEASE", "ROLLBACK")):
+            sent.append((sql, parameters[0] if executemany else parameters))
+    savepoint = db.session.begin_nested()
+    event.listen(db.engine, "before_cursor_execute", capture)
+    try:
+        run()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", capture)
+        savepoint.rollback()
+    return sent
+
+def explain(run):
+    """EXPLAIN each statement `run` sends."""
+    plan = []
+    for sql, parameters in sent_statements(run):
+        if db.engine.dialect.name == "postgresql":
+            plan += [row[0] for row in db.session.connection().exec_driver_sql("EXPLAIN " + sql, parameters)]
+        else:
+            plan += [row[-1] for row in db.session.connection().exec_driver_sql("EXPLAIN QUERY PLAN " + sql, parameters)]
+    return plan
+
+def query_work(run):
+    """How hard the database worked on the statements `run` sends (which
+    must only read): buffer pages touched on PostgreSQL, hundreds of VM
+    instructions on SQLite. Only comparable with itself."""
+    connection = db.session.connection()
+    work = 0
+    for sql, parameters in sent_statements(run):
+        if db.engine.dialect.name == "postgresql":
+            plan = connection.exec_driver_sql("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, parameters).scalar()
+            work += plan[0]["Plan"]["Shared Hit Blocks"] + plan[0]["Plan"]["Shared Read Blocks"]
+            continue
+        steps = [0]
+        def count():
+            steps[0] += 1
+        sqlite = connection.connection.driver_connection
+        sqlite.set_progress_handler(count, 100)
+        try:
+            connection.exec_driver_sql(sql, parameters).all()
+        finally:
+            sqlite.set_progress_handler(None, 100)
+        work += steps[0]
+    return work
+
+def is_full_scan(plan_line):
+    if db.engine.dialect.name == "postgresql":
+        return "Seq Scan" in plan_line
+    return (plan_line.startswith("SCAN ") and " USING " not in plan_line) or "TEMP B-TREE" in plan_line
+
+@bp.cli.command("check-indexes")
+def check_indexes_command():
+    """EXPLAIN the hot queries and fail if any scans or sorts a whole table,
+    or if a keyset listing's last page costs much more than its first."""
+    if db.engine.dialect.name == "postgresql":
+        # Tiny tables make the planner prefer seq scans even with an index.
+        db.session.execute(text("SET LOCAL enable_seqscan = off"))
+    failed = []
+    for name, run in hot_queries().items():
+        plan = explain(run)
+        ok = not any(is_full_scan(line) for line in plan)
+        print(f"{'ok  ' if ok else 'FAIL'} {name}: {' / '.join(line.strip() for line in plan)}")
+        if not ok:
+            failed.append(name)
+    for name, (first, last) in keyset_samples().items():
+        first_work, last_work = query_work(first), query_work(last)
+        # Slack for the cursor lookup and small tables.
+        ok = last_work <= 2 * first_work + 10
+        print(f"{'ok  ' if ok else 'FAIL'} {name}, last page: work {last_work} (first page: {first_work})")
+        if not ok:
+            failed.append(f"{name} (seek not bounded by its cursor)")
+    db.session.rollback()
+    if failed:
+        raise click.ClickException(f"No index used by: {', '.join(failed)}")
+
 # --- ROUTES ---
-@app.route("/set_language/<lang>")
+@bp.route("/set_language/<lang>")
 def set_language(lang):
-    if lang in ['en', 'ar']:
+    if lang in current_app.config['LANGUAGES']:
         session['lang'] = lang
-    return redirect(request.referrer or url_for('home'))
+    return redirect(request.referrer or url_for('main.home'))
 
-@app.route("/")
+@bp.route("/")
+@read_only
+@conditional_get()
+@cached_page
 def home():
-    lang = get_language()
-    return render_template(f"{lang}/home.html", user=current_user())
+    return render_template("home.html", user=current_user())
 
-@app.route("/login", methods=["GET","POST"])
+@bp.route("/login", methods=["GET","POST"])
 def login():
-    lang = get_language()
     if request.method=="POST":
-        user = User.query.filter_by(username=request.form['username']).first()
-        if user and user.password == request.form['password']:
+        wait = login_throttled(request.form['username'])
+        if wait:
+            flash(gettext("Too many login attempts, try again later!"))
+            return retry_after(make_response(render_template("login.html", user=current_user()), 429), wait)
+        try:
+            user = check_login(request.form['username'], request.form['password'])
+        except PasswordHasherBusy:
+            flash(gettext("The server is busy, try again in a moment!"))
+            return retry_after(make_response(render_template("login.html", user=current_user()), 503), 1)
+        if user:
+            rotate_session()
             session['user_id'] = user.id
-            flash("Logged in successfully!")
-            return redirect(url_for('home'))
+            flash(gettext("Logged in successfully!"))
+            return redirect(url_for('main.home'))
         else:
-            flash("Invalid credentials!")
-    return render_template(f"{lang}/login.html", user=current_user())
+            flash(gettext("Invalid credentials!"))
+    return render_template("login.html", user=current_user())
 
-@app.route("/register", methods=["GET","POST"])
+@bp.route("/register", methods=["GET","POST"])
 def register():
-    lang = get_language()
     if request.method=="POST":
         username = request.form['username']
         password = request.form['password']
+        wait = login_throttled()
+        if wait:
+            flash(gettext("Too many attempts, try again later!"))
+            return retry_after(make_response(render_template("register.html", user=current_user()), 429), wait)
         if User.query.filter_by(username=username).first():
-            flash("Username already exists!")
+            flash(gettext("Username already exists!"))
         else:
+            try:
+                password = current_app.extensions["password_hasher"].hash(password)
+            except PasswordHasherBusy:
+                flash(gettext("The server is busy, try again in a moment!"))
+                return retry_after(make_response(render_template("register.html", user=current_user()), 503), 1)
             new_user = User(username=username, password=password)
             db.session.add(new_user)
             db.session.commit()
-            flash("User registered!")
-            return redirect(url_for('login'))
-    return render_template(f"{lang}/register.html", user=current_user())
+            flash(gettext("User registered!"))
+            return redirect(url_for('main.login'))
+    return render_template("register.html", user=current_user())
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
-    session.pop('user_id', None)
-    flash("Logged out!")
-    return redirect(url_for('home'))
+    uid = session.pop('user_id', None)
+    if uid:
+        current_app.extensions["user_cache"].pop(uid)
+    g.pop('_current_user', None)
+    flash(gettext("Logged out!"))
+    return redirect(url_for('main.home'))
 
-@app.route("/books")
+@bp.route("/books")
+@read_only
+@conditional_get()
+@cached_page
 def books():
-    lang = get_language()
-    books_list = Book.query.all()
-    return render_template(f"{lang}/books.html", user=current_user(), books=books_list)
+    page, starts = book_page()
+    return render_template("books.html", user=current_user(), books=page.items, page=page, starts=starts)
 
-@app.route("/reserve/<int:book_id>", methods=["POST"])
+@bp.route("/search")
+@read_only
+@conditional_get()
+def search():
+    q = request.args.get('q', '').strip()
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = get_per_page()
+    results, has_next = search_books(q, page, per_page)
+    return render_template("search.html", user=current_user(), q=q, books=results,
+                           page=page, per_page=per_page, has_next=has_next)
+
+@bp.route("/reserve/<int:book_id>", methods=["POST"])
 def reserve(book_id):
     user = current_user()
     if not user:
-        flash("Login first!")
-        return redirect(url_for('login'))
-    book = Book.query.get(book_id)
-    if book and book.copies > 0:
-        book.copies -= 1
-        booking = Booking(user_id=user.id, book_id=book.id)
-        db.session.add(booking)
-        db.session.commit()
-        flash("Book reserved successfully!")
+        flash(gettext("Login first!"))
+        return redirect(url_for('main.login'))
+    if reserve_copy(user.id, book_id):
+        flash(gettext("Book reserved successfully!"))
     else:
-        flash("Book not available!")
-    return redirect(url_for('books'))
+        flash(gettext("Book not available!"))
+    return redirect(url_for('main.books'))
 
-@app.route("/my_bookings")
+@bp.route("/reserve", methods=["POST"])
+def reserve_many():
+    user = current_user()
+    if not user:
+        flash(gettext("Login first!"))
+        return redirect(url_for('main.login'))
+    book_ids = request.form.getlist('book_id', type=int)
+    if not book_ids:
+        flash(gettext("No books selected!"))
+        return redirect(url_for('main.books'))
+    limit = current_app.config['MAX_BATCH_RESERVATIONS']
+    if len(book_ids) > limit:
+        flash(gettext("Select at most %(limit)d books at a time (you selected %(total)d).",
+                      limit=limit, total=len(book_ids)))
+        return redirect(url_for('main.books'))
+    booking_ids = reserve_copies(user.id, book_ids)
+    reserved = sum(1 for b in booking_ids if b)
+    flash(gettext("Reserved %(reserved)d of %(total)d books.", reserved=reserved, total=len(book_ids)))
+    return redirect(url_for('main.my_bookings') if reserved else url_for('main.books'))
+
+@bp.route("/return/<int:booking_id>", methods=["POST"])
+def return_book(booking_id):
+    user = current_user()
+    if not user:
+        flash(gettext("Login first!"))
+        return redirect(url_for('main.login'))
+    if return_booking(user.id, booking_id):
+        flash(gettext("Book returned!"))
+    else:
+        flash(gettext("No open booking to return!"))
+    return redirect(url_for('main.my_bookings'))
+
+@bp.route("/my_bookings")
+@read_only
+@conditional_get()
 def my_bookings():
-    lang = get_language()
     user = current_user()
     if not user:
-        flash("Login first!")
-        return redirect(url_for('login'))
-    bookings = Booking.query.filter_by(user_id=user.id).all()
-    bookings_info = [{"book_title": Book.query.get(b.book_id).title, "date": b.date.strftime("%Y-%m-%d"), "status": b.status} for b in bookings]
-    return render_template(f"{lang}/my_bookings.html", user=user, bookings=bookings_info)
+        flash(gettext("Login first!"))
+        return redirect(url_for('main.login'))
+    page = booking_page(user.id, get_per_page())
+    bookings_info = [{"id": b.id, "book_title": b.book.title if b.book else "", "date": b.date.strftime("%Y-%m-%d"), "status": b.status} for b in page.items]
+    return render_template("my_bookings.html", user=user, bookings=bookings_info, page=page)
 
 # --- ADMIN ---
-@app.route("/admin")
+@bp.route("/admin")
+@read_only
 def admin_index():
-    lang = get_language()
     u = current_user()
     if not u or u.username != "admin":
-        flash("Admin only!")
-        return redirect(url_for('home'))
-    books_list = Book.query.all()
-    return render_template(f"{lang}/admin_index.html", user=u, books=books_list)
+        flash(gettext("Admin only!"))
+        return redirect(url_for('main.home'))
+    page = keyset_page(Book.query, (Book.id,), get_per_page())
+    return render_template("admin_index.html", user=u, books=page.items, page=page)
 
-@app.route("/admin/add_book", methods=["GET","POST"])
+@bp.route("/admin/add_book", methods=["GET","POST"])
 def admin_add_book():
-    lang = get_language()
     u = current_user()
     if not u or u.username != "admin":
-        flash("Admin only!")
-        return redirect(url_for('home'))
+        flash(gettext("Admin only!"))
+        return redirect(url_for('main.home'))
     if request.method=="POST":
         title = request.form['title']
         author = request.form['author']
         copies = int(request.form['copies'])
-        new_book = Book(title=title, author=author, copies=copies)
+        image = request.files.get('image')
+        image_filename = None
+        if image and image.filename:
+            import covers  # Pillow is only needed for cover images
+            try:
+                image_filename = covers.save_original(image.stream, cover_dir())
+            except ValueError:
+                flash(gettext("Book image must be a picture!"))
+                return redirect(url_for('main.admin_add_book'))
+        new_book = Book(title=title, author=author, copies=copies, image_filename=image_filename)
         db.session.add(new_book)
+        if image_filename:
+            enqueue("render_cover", image_filename=image_filename)
+        bump_catalog_version()
         db.session.commit()
-        flash("Book added!")
-        return redirect(url_for('admin_index'))
-    return render_template(f"{lang}/admin_add_book.html", user=u)
+        flash(gettext("Book added!"))
+        return redirect(url_for('main.admin_index'))
+    return render_template("admin_add_book.html", user=u)
 
-@app.route("/recs")
+@bp.route("/recs")
+@read_only
+@conditional_get()
+@cached_page
 def recs():
-    lang = get_language()
-    # Just return some books as recommendations
-    books_list = Book.query.limit(5).all()
-    return render_template(f"{lang}/recs.html", user=current_user(), recs=books_list)
+    user = current_user()
+    books_list = recommend_books(user, current_app.config['RECS_COUNT'])
+    return render_template("recs.html", user=user, recs=books_list)
+
+# API ---
+# JSON twins of the catalog, reservation and recommendation pages for the
+# mobile app and kiosks. Clients log in through /api/v1/login and then
+# use the session cookie. Every list takes ?fields=a,b to trim its items.
+# Reads go through conditional_get(), so an unchanged page is answered 304
+# before any book is queried.
+BOOK_FIELDS = ("id", "title", "author", "copies", "available")
+BOOKING_FIELDS = ("id", "book_id", "title", "date", "status")
+
+def book_json(b):
+    return {"id": b.id, "title": b.title, "author": b.author, "copies": b.copies, "available": b.available}
+
+def booking_json(bk):
+    return {"id": bk.id, "book_id": bk.book_id, "title": bk.book.title if bk.book else "",
+            "date": bk.date.isoformat(timespec="seconds"), "status": bk.status}
+
+def api_error(message, status):
+    return api_response({"error": message}, status)
+
+def api_response(payload, status=200):
+    """Compact JSON. GET responses outside conditional_get() get the body's
+    hash as ETag and are answered 304 when it matches If-None-Match."""
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    response = current_app.response_class(body, status=status, mimetype="application/json")
+    if request.method == "GET" and status == 200 and 'catalog_etag' not in g:
+        response.set_etag(hashlib.blake2b(body.encode(), digest_size=16).hexdigest())
+        response.make_conditional(request)
+    return response
+
+def requested_fields(allowed):
+    """The ?fields= selection, or all of `allowed`; None if it names an unknown field."""
+    fields = [f for f in request.args.get('fields', '').split(',') if f]
+    if not fields:
+        return allowed
+    return fields if set(fields) <= set(allowed) else None
+
+def unknown_fields(allowed):
+    return api_error(f"fields must be a subset of {','.join(allowed)}", 400)
+
+def api_items(items, to_json, allowed, **extra):
+    fields = requested_fields(allowed)
+    if fields is None:
+        return unknown_fields(allowed)
+    return api_response({"items": [{f: d[f] for f in fields} for d in map(to_json, items)], **extra})
+
+@api.route("/login", methods=["POST"])
+def api_login():
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data.get('username'), str) or not isinstance(data.get('password'), str):
+        return api_error("username and password must be strings", 400)
+    wait = login_throttled(data['username'])
+    if wait:
+        return retry_after(api_error("Too many login attempts", 429), wait)
+    try:
+        user = check_login(data['username'], data['password'])
+    except PasswordHasherBusy:
+        return retry_after(api_error("Server busy", 503), 1)
+    if not user:
+        return api_error("Invalid credentials", 401)
+    rotate_session()
+    session['user_id'] = user.id
+    return api_response({"id": user.id, "username": user.username})
+
+@api.route("/logout", methods=["POST"])
+def api_logout():
+    uid = session.pop('user_id', None)
+    if uid:
+        current_app.extensions["user_cache"].pop(uid)
+    g.pop('_current_user', None)
+    return api_response({})
+
+@api.route("/books")
+@read_only
+@conditional_get(personal=False)
+def api_books():
+    page, _ = book_page()
+    return api_items(page.items, book_json, BOOK_FIELDS, next_cursor=page.next_cursor, prev_cursor=page.prev_cursor)
+
+@api.route("/books/<int:book_id>")
+@read_only
+@conditional_get(personal=False)
+def api_book(book_id):
+    book = db.session.get(Book, book_id)
+    if not book:
+        return api_error("Book not found", 404)
+    fields = requested_fields(BOOK_FIELDS)
+    if fields is None:
+        return unknown_fields(BOOK_FIELDS)
+    data = book_json(book)
+    return api_response({f: data[f] for f in fields})
+
+@api.route("/search")
+@read_only
+@conditional_get(personal=False)
+def api_search():
+    page = max(1, request.args.get('page', 1, type=int))
+    results, has_next = search_books(request.args.get('q', '').strip(), page, get_per_page())
+    return api_items(results, book_json, BOOK_FIELDS, next_page=page + 1 if has_next else None)
+
+@api.route("/books/<int:book_id>/reserve", methods=["POST"])
+def api_reserve(book_id):
+    user = current_user()
+    if not user:
+        return api_error("Login required", 401)
+    booking_id = reserve_copy(user.id, book_id)
+    if not booking_id:
+        return api_error("Book not available", 409)
+    return api_response({"id": booking_id, "book_id": book_id, "status": "Reserved"}, 201)
+
+@api.route("/reservations", methods=["POST"])
+def api_reserve_many():
+    user = current_user()
+    if not user:
+        return api_error("Login required", 401)
+    book_ids = (request.get_json(silent=True) or {}).get('book_ids')
+    limit = current_app.config['MAX_BATCH_RESERVATIONS']
+    if not isinstance(book_ids, list) or not all(type(b) is int for b in book_ids):
+        return api_error("book_ids must be a list of integers", 400)
+    if not 0 < len(book_ids) <= limit:
+        return api_error(f"Reserve between 1 and {limit} books at a time", 400)
+    results = [{"book_id": book_id, "id": booking_id, "status": "Reserved" if booking_id else "Unavailable"}
+               for book_id, booking_id in zip(book_ids, reserve_copies(user.id, book_ids))]
+    return api_response({"items": results})
+
+@api.route("/bookings")
+@read_only
+@conditional_get()
+def api_bookings():
+    user = current_user()
+    if not user:
+        return api_error("Login required", 401)
+    page = booking_page(user.id, get_per_page())
+    return api_items(page.items, booking_json, BOOKING_FIELDS, next_cursor=page.next_cursor, prev_cursor=page.prev_cursor)
+
+@api.route("/bookings/<int:booking_id>/return", methods=["POST"])
+def api_return(booking_id):
+    user = current_user()
+    if not user:
+        return api_error("Login required", 401)
+    if not return_booking(user.id, booking_id):
+        return api_error("No open booking to return", 409)
+    return api_response({"id": booking_id, "status": "Returned"})
+
+@api.route("/recs")
+@read_only
+@conditional_get()
+def api_recs():
+    return api_items(recommend_books(current_user(), current_app.config['RECS_COUNT']), book_json, BOOK_FIELDS)
+
+# --- METRICS ---
+# Opt-in (METRICS_ENABLED). Each request's SQL statements and template
+# renders are timed through SQLAlchemy engine events and Flask signals and
+# folded into histograms per endpoint, so a route whose query count grows
+# with its page size (an N+1) stands out in maktabty_request_sql_queries.
+metrics_bp = Blueprint("metrics", __name__)
+
+class Histogram:
+    """Prometheus-style cumulative histogram keyed by a tuple of label values."""
+
+    def __init__(self, name, help, labels, buckets):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        with self._lock:
+            counts, total = self.series.get(label_values, ([0] * (len(self.buckets) + 1), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self.series[label_values] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((k, (list(c), s)) for k, (c, s) in self.series.items())
+        for label_values, (counts, total) in series:
+            labels = ",".join(f'{k}="{prometheus_escape(v)}"' for k, v in zip(self.labels, label_values))
+            sep = "," if labels else ""
+            for bound, count in zip([*self.buckets, "+Inf"], counts):
+                lines.append(f'{self.name}_bucket{{{labels}{sep}le="{bound}"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {counts[-1]}")
+        return "\n".join(lines)
+
+def prometheus_escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metrics:
+    def __init__(self):
+        self.request_seconds = Histogram(
+            "maktabty_request_duration_seconds", "Time to build a response.",
+            ("endpoint", "method", "status"), SECONDS)
+        self.sql_queries = Histogram(
+            "maktabty_request_sql_queries", "SQL statements executed per request.",
+            ("endpoint",), (0, 1, 2, 3, 5, 10, 20, 50, 100))
+        self.sql_seconds = Histogram(
+            "maktabty_request_sql_seconds", "Time spent in SQL per request.", ("endpoint",), SECONDS)
+        self.template_seconds = Histogram(
+            "maktabty_template_render_seconds", "Time to render a template.", ("template",), SECONDS)
+        self.response_bytes = Histogram(
+            "maktabty_response_bytes", "Response body size.",
+            ("endpoint",), (256, 1024, 4096, 16384, 65536, 262144, 1048576))
+
+    def render(self):
+        return "\n".join(h.render() for h in vars(self).values()) + "\n"
+
+class SamplingProfiler:
+    """Samples every other thread's stack each `interval` seconds while
+    running. folded() returns "outer;...;inner count" lines, the input of
+    flamegraph.pl and speedscope."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        self.stacks.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        return self.folded()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+def init_metrics(app):
+    metrics = app.extensions["metrics"] = Metrics()
+    app.extensions["profiler"] = SamplingProfiler(app.config['METRICS_PROFILE_INTERVAL'])
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        if has_request_context() and "metrics_sql" in g:
+            g.metrics_sql[0] += 1
+            g.metrics_sql[1] += elapsed
+
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, "before_cursor_execute", before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+    def render_started(sender, template, context, **extra):
+        g.setdefault("metrics_renders", []).append(time.perf_counter())
+
+    def render_finished(sender, template, context, **extra):
+        metrics.template_seconds.observe((template.name,), time.perf_counter() - g.metrics_renders.pop())
+
+    before_render_template.connect(render_started, app, weak=False)
+    template_rendered.connect(render_finished, app, weak=False)
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        g.metrics_sql = [0, 0.0]
+
+    @app.after_request
+    def record_request_metrics(response):
+        if "metrics_started" in g:
+            endpoint = request.endpoint or "unmatched"
+            metrics.request_seconds.observe((endpoint, request.method, response.status_code),
+                                            time.perf_counter() - g.metrics_started)
+            metrics.sql_queries.observe((endpoint,), g.metrics_sql[0])
+            metrics.sql_seconds.observe((endpoint,), g.metrics_sql[1])
+            if response.content_length is not None:
+                metrics.response_bytes.observe((endpoint,), response.content_length)
+        return response
+
+    app.register_blueprint(metrics_bp)
+
+@metrics_bp.route("/metrics")
+def metrics_endpoint():
+    body = current_app.extensions["metrics"].render()
+    return current_app.response_class(body, mimetype="text/plain; version=0.0.4")
+
+@metrics_bp.route("/metrics/profile", methods=["POST"])
+def profile():
+    """?action=start begins sampling; ?action=stop ends it and returns the
+    folded stacks (e.g. `flamegraph.pl < stacks.txt > flame.svg`)."""
+    u = current_user()
+    if not u or u.username != "admin":
+        abort(403)
+    profiler = current_app.extensions.get("profiler")
+    if profiler is None:
+        return current_app.response_class("profiling is off under `flask serve`: start and stop would "
+                                          "reach different workers\n", status=409, mimetype="text/plain")
+    action = request.args.get("action")
+    if action == "start" and not profiler.running:
+        profiler.start()
+        return current_app.response_class("profiling\n", mimetype="text/plain")
+    if action == "stop" and profiler.running:
+        return current_app.response_class(profiler.stop(), mimetype="text/plain")
+    return current_app.response_class(f"profiler is {'running' if profiler.running else 'stopped'}\n",
+                                      status=409, mimetype="text/plain")
+
+# --- SERVER ---
+@bp.route("/healthz")
+def healthz():
+    """For load balancers: 200 while this worker can reach the database."""
+    try:
+        db.session.execute(text("SELECT 1"))
+    except Exception:
+        db.session.rollback()
+        current_app.logger.exception("Health check failed")
+        return {"status": "unavailable"}, 503, {"Cache-Control": "no-store"}
+    return {"status": "ok"}, 200, {"Cache-Control": "no-store"}
+
+def warm_up(app):
+    """Compile every template and freeze the heap before workers fork, so
+    they start ready and share those pages instead of copying them."""
+    for name in app.jinja_env.list_templates(filter_func=lambda name: name.endswith(".html")):
+        app.jinja_env.get_template(name)
+    gc.collect()
+    gc.freeze()  # keep the collector from touching (and so copying) shared objects
+
+def reset_after_fork(app):
+    # Pooled connections opened before the fork belong to the master; a
+    # worker must open its own rather than share the sockets.
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+@bp.cli.command("serve")
+@click.option("--bind", default="127.0.0.1:8000", show_default=True, help="Address to listen on.")
+@click.option("--workers", type=int, default=os.cpu_count() or 1, show_default="one per CPU",
+              help="Worker processes.")
+@click.option("--threads", default=4, show_default=True, help="Request threads per worker.")
+@click.option("--timeout", default=30, show_default=True, help="Seconds before a stuck worker is restarted.")
+@click.option("--graceful-timeout", default=30, show_default=True,
+              help="Seconds a stopping worker gets to finish its requests.")
+@click.option("--max-requests", default=0, show_default=True,
+              help="Restart each worker after this many requests (0: never).")
+def serve_command(bind, workers, threads, timeout, graceful_timeout, max_requests):
+    """Serve the app with gunicorn (Linux/macOS) for production.
+
+    The app is built once in the master and forked into the workers. On
+    SIGHUP the master replaces its workers one by one; in-flight requests
+    finish first. Since the code is preloaded, deploy new code with SIGUSR2
+    (starts a new master beside the old one) followed by SIGQUIT to the
+    old master. Background jobs still need `flask worker`.
+
+    Some state is kept per worker process, and each request reaches
+    whichever worker is free:
+
+    \b
+    - /metrics shows one worker's histograms per scrape, so with several
+      workers the counts jump back and forth; scrape a --workers 1
+      instance instead.
+    - /metrics/profile is disabled, since start and stop would land on
+      different workers.
+    - The login limiter's buckets are per worker, so a client gets up to
+      workers x LOGIN_BURST attempts; lower LOGIN_BURST to match.
+    """
+    from gunicorn.app.base import BaseApplication  # only needed to serve
+
+    app = current_app._get_current_object()
+    app.extensions.pop("profiler", None)
+    options = {
+        "bind": bind, "workers": workers, "threads": threads, "worker_class": "gthread",
+        "timeout": timeout, "graceful_timeout": graceful_timeout,
+        "max_requests": max_requests, "max_requests_jitter": max_requests // 10,
+        "preload_app": True, "post_fork": lambda server, worker: reset_after_fork(app),
+    }
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            warm_up(app)
+            return app
+
+    Server().run()
+
+# --- APP FACTORY ---
+def is_sqlite_memory(uri):
+    return uri in ("sqlite://", "sqlite:///:memory:")
+
+def sqlite_pragma_setter(pragmas):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+    return set_pragmas
+
+def create_app(config=None):
+    """Build the app. Cheap by design: no queries and no schema work, and the
+    engine only connects on first use. Use `flask init-db` / `flask seed`
+    to prepare a database."""
+    app = Flask(__name__, template_folder="Templates")
+    app.config.from_object(Config)
+    if config:
+        app.config.update(config)
+    app.config['BUILD_ID'] = app.config['BUILD_ID'] or build_id(app)
+    if app.config['PROXY_FIX_HOPS']:
+        hops = app.config['PROXY_FIX_HOPS']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
+    if not is_sqlite_memory(app.config['SQLALCHEMY_DATABASE_URI']):
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            "pool_size": app.config['DB_POOL_SIZE'],
+            "max_overflow": app.config['DB_MAX_OVERFLOW'],
+            **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}),
+        }
+    db.init_app(app)
+    migrate.init_app(app, db)
+    babel.init_app(app, locale_selector=get_language)
+    template_cache = app.config['TEMPLATE_CACHE_DIR'] or os.path.join(app.instance_path, "jinja-cache")
+    os.makedirs(template_cache, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(template_cache)
+    if app.config['SQLITE_PRAGMAS']:
+        with app.app_context():
+            for engine in db.engines.values():
+                if engine.dialect.name == "sqlite":
+                    event.listen(engine, "connect", sqlite_pragma_setter(app.config['SQLITE_PRAGMAS']))
+    app.extensions["user_cache"] = LRUCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+    # Rendered catalog pages keyed by (endpoint, lang, catalog version, query string).
+    app.extensions["page_cache"] = LRUCache(app.config['PAGE_CACHE_BYTES'], sizeof=sys.getsizeof)
+    app.extensions["job_worker"] = WorkerThread(app)
+    if app.config['SESSION_STORE'] != "cookie":
+        app.extensions["session_store"] = (RedisSessionStore(app.config['SESSION_REDIS_URL'])
+                                           if app.config['SESSION_STORE'] == "redis" else DatabaseSessionStore())
+        app.session_interface = ServerSessionInterface(app.extensions["session_store"])
+    app.extensions["password_hasher"] = PasswordHasher(
+        app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_WORKERS'],
+        app.config['PASSWORD_HASH_QUEUE'], app.config['PASSWORD_HASH_TIMEOUT'])
+    app.extensions["login_limiter"] = (TokenBuckets(app.config['LOGIN_BURST'], app.config['LOGIN_PER_MINUTE'] / 60)
+                                       if app.config['LOGIN_BURST'] else None)
+    app.register_blueprint(bp)
+    app.register_blueprint(api)
+    if app.config['METRICS_ENABLED']:
+        init_metrics(app)
+
+    @app.url_defaults
+    def fingerprint_static(endpoint, values):
+        if endpoint == "static" and "filename" in values:
+            values.setdefault("v", static_fingerprint(values["filename"]))
+
+    @app.after_request
+    def cache_fingerprinted_static(response):
+        # Only a URL naming the current content may be cached for good.
+        version = request.args.get("v")
+        if request.endpoint == "static" and version and version == static_fingerprint(request.view_args["filename"]):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config['STATIC_MAX_AGE']
+            response.cache_control.immutable = True
+        return response
+
+    @app.before_request
+    def start_job_worker():
+        app.extensions["job_worker"].start()
+
+    @app.after_request
+    def pin_writer_to_primary(response):
+        # Replicas lag a little; keep a user who just wrote on the primary.
+        if g.get('wrote') and app.config['SQLALCHEMY_BINDS'].get('replica'):
+            session['primary_until'] = time.time() + app.config['REPLICA_LAG_SECONDS']
+        return response
+
+    return app
 
 # --- RUN APP ---
+# Development server with the debugger; in production use `flask serve`.
 if __name__ == "__main__":
+    app = create_app({"JOBS_IN_PROCESS": True})
+    with app.app_context():
+        init_db()
+        seed_db()
     app.run(debug=True)
-###############################################################################################
\ No newline at end of file
+###############################################################################################
\ No newline at end of file
@@ -0,0 +1,312 @@
+# bench.py
+# Load benchmark for the catalog and reservation paths.
+#
+#   python bench.py --scale 10k --save bench-data/baseline.json
+#   python bench.py --scale 10k --compare bench-data/baseline.json
+#
+# The synthetic catalog and booking history for a scale is seeded once into
+# bench-data/seed-<scale>.db, and every run works on a fresh copy of it so
+# runs are comparable. Each route is then driven on its own by --users
+# simulated, logged-in readers (Flask test clients on threads, in this
+# process) for --seconds. The report has latency percentiles, throughput,
+# SQL statements per request and peak RSS per route, and a check that no
+# book was oversold, which ends with loadtest_reserve.py's race for a
+# single book. --compare exits with status 1 if a route's p95 or
+# throughput got worse than the baseline by more than --threshold.
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, text
+
+from Maktabty import (Book, Booking, User, create_app, db, init_db, insert_batches, reconcile_availability,
+                      train_recommendations, upsert_books)
+from loadtest_reserve import race
+
+SCALES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench-data")
+WORDS = ("river night garden stone city light shadow winter history data science python flask web "
+         "programming modern art music war peace ocean desert mountain child king queen story "
+         "secret journey machine learning design theory practice world heart mind road home").split()
+NAMES = "Ahmed Sara Omar Laila John Maria Wei Yuki Ivan Fatima Carlos Amina".split()
+SURNAMES = "Hassan Smith Chen Garcia Khan Ivanova Tanaka Mansour Silva Okafor".split()
+PASSWORD = "bench-password"
+
+
+# --- SEEDING ---
+def seed(app, books, train, rng):
+    """Fill an empty database with `books` books, a tenth as many readers and
+    two bookings per book, a tenth of them still open."""
+    with app.app_context():
+        init_db()
+        if db.session.query(Book.id).first():
+            return
+        started = time.perf_counter()
+        readers = max(100, books // 10)
+        insert_batches(User, ({"username": f"reader{i}", "password": PASSWORD} for i in range(readers)))
+        batch = []
+        for _ in range(books):
+            batch.append({"id": None, "title": " ".join(rng.choice(WORDS) for _ in range(3)).title(),
+                          "author": f"{rng.choice(NAMES)} {rng.choice(SURNAMES)}", "copies": rng.randint(1, 5)})
+            if len(batch) == 5000:
+                upsert_books(batch)
+                batch = []
+        if batch:
+            upsert_books(batch)
+        db.session.commit()
+        user_ids = db.session.execute(db.select(User.id)).scalars().all()
+        book_ids = db.session.execute(db.select(Book.id)).scalars().all()
+        start = datetime(2025, 1, 1)
+        open_per_book = {}
+
+        def bookings():
+            for i in range(books * 2):
+                book_id = rng.choice(book_ids)
+                status = "Returned"
+                if rng.random() < 0.1 and open_per_book.get(book_id, 0) < 1:
+                    open_per_book[book_id] = 1
+                    status = "Reserved"
+                yield {"user_id": rng.choice(user_ids), "book_id": book_id,
+                       "date": start + timedelta(minutes=i), "status": status}
+        insert_batches(Booking, bookings())
+        db.session.commit()
+        reconcile_availability()
+        if train:
+            train_recommendations()
+        if db.engine.dialect.name == "sqlite":
+            db.session.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+        db.session.commit()
+        print(f"Seeded {books} books, {readers} readers and {books * 2} bookings "
+              f"in {time.perf_counter() - started:.0f}s.")
+
+
+# --- SCENARIOS ---
+# Each route yields (method, url, request kwargs) for one request of a user.
+def scenarios(book_ids):
+    letters = sorted({w[0].upper() for w in WORDS})
+    return {
+        "books": lambda rng: ("GET", f"/books?after={rng.choice(book_ids)}", {}),
+        "books_by_title": lambda rng: ("GET", f"/books?starts={rng.choice(letters)}", {}),
+        "search": lambda rng: ("GET", f"/search?q={rng.choice(WORDS)}", {}),
+        "my_bookings": lambda rng: ("GET", "/my_bookings", {}),
+        "recs": lambda rng: ("GET", "/recs", {}),
+        "api_books": lambda rng: ("GET", f"/api/v1/books?after={rng.choice(book_ids)}&fields=id,title", {}),
+        "reserve": lambda rng: ("POST", f"/reserve/{rng.choice(book_ids)}", {}),
+        "reserve_batch": lambda rng: ("POST", "/api/v1/reservations",
+                                      {"json": {"book_ids": rng.sample(book_ids, 5)}}),
+    }
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:  # not Linux: peak so far, in KB (bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def percentile(ordered, p):
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)] if ordered else 0.0
+
+
+def run_route(app, clients, make_request, seconds, seed_value):
+    """Drive one route with every client at once; returns its stats."""
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1  # a lost update under contention only blurs the average
+    with app.app_context():
+        engines = list(db.engines.values())
+    for engine in engines:
+        event.listen(engine, "after_cursor_execute", count)
+
+    peak = [rss_bytes()]
+    done = threading.Event()
+
+    def sample_rss():
+        while not done.wait(0.05):
+            peak[0] = max(peak[0], rss_bytes())
+
+    per_user = [[] for _ in clients]
+    errors = [0] * len(clients)
+    deadline = time.perf_counter() + seconds
+
+    def user(n):
+        rng = random.Random(seed_value * 1000 + n)
+        client = clients[n]
+        while time.perf_counter() < deadline:
+            method, url, kwargs = make_request(rng)
+            started = time.perf_counter()
+            response = client.open(url, method=method, **kwargs)
+            per_user[n].append(time.perf_counter() - started)
+            if response.status_code >= 500:
+                errors[n] += 1
+
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    sampler.start()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=user, args=(n,)) for n in range(len(clients))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    done.set()
+    sampler.join()
+    for engine in engines:
+        event.remove(engine, "after_cursor_execute", count)
+
+    latencies = sorted(x for xs in per_user for x in xs)
+    requests = len(latencies)
+    return {
+        "requests": requests,
+        "errors": sum(errors),
+        "throughput_rps": requests / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": sum(latencies) / requests * 1000 if requests else 0.0,
+        "queries_per_request": statements[0] / requests if requests else 0.0,
+        "peak_rss_mb": peak[0] / 2 ** 20,
+    }
+
+
+def check_consistency(app, users):
+    """Oversold books and counters that disagree with the bookings table,
+    after 4 * `users` readers race for the 2 * `users` copies of one book."""
+    contended = race(app, 4 * users, 2 * users)
+    with app.app_context():
+        oversold = db.session.query(Book.id).filter(Book.reserved > Book.copies).count()
+        drifted = reconcile_availability()
+    return {"oversold": oversold, "drifted": drifted, "race": contended}
+
+
+# --- REPORTING ---
+COLUMNS = {"requests": "requests", "errors": "errors", "throughput_rps": "req/s", "p50_ms": "p50 ms",
+           "p95_ms": "p95 ms", "p99_ms": "p99 ms", "queries_per_request": "queries", "peak_rss_mb": "RSS MB"}
+
+
+def print_results(results):
+    print(f"{'route':<16}" + "".join(f"{title:>10}" for title in COLUMNS.values()))
+    for route, stats in results["routes"].items():
+        print(f"{route:<16}" + "".join(f"{stats[c]:>10.1f}" if isinstance(stats[c], float) else f"{stats[c]:>10}"
+                                       for c in COLUMNS))
+    print(f"consistency: {results['consistency']}")
+
+
+def compare(results, baseline, threshold):
+    """Print per-route changes against `baseline`; return the routes whose p95
+    rose or throughput fell by more than `threshold` (a fraction)."""
+    regressed = []
+    print(f"\n{'route':<16}{'p50':>10}{'p95':>10}{'p99':>10}{'throughput':>12}{'queries':>10}   vs {baseline['meta']}")
+    for route, now in results["routes"].items():
+        before = baseline["routes"].get(route)
+        if not before:
+            continue
+
+        def change(key):
+            return (now[key] - before[key]) / before[key] if before[key] else 0.0
+        p95, throughput = change("p95_ms"), change("throughput_rps")
+        print(f"{route:<16}{change('p50_ms'):>+10.0%}{p95:>+10.0%}{change('p99_ms'):>+10.0%}"
+              f"{throughput:>+12.0%}{now['queries_per_request'] - before['queries_per_request']:>+10.1f}")
+        if p95 > threshold or -throughput > threshold:
+            regressed.append(route)
+    return regressed
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+# --- MAIN ---
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the catalog and reservation routes.")
+    parser.add_argument("--scale", choices=SCALES, default="10k", help="catalog size to seed")
+    parser.add_argument("--database-url", help="benchmark this (empty or previously seeded) database "
+                                               "in place instead of a copy of bench-data/seed-<scale>.db")
+    parser.add_argument("--users", type=int, default=16, help="concurrent simulated readers")
+    parser.add_argument("--seconds", type=float, default=10, help="measured time per route")
+    parser.add_argument("--warmup", type=float, default=2, help="unmeasured time per route before that")
+    parser.add_argument("--routes", help="comma-separated subset of: " + ",".join(scenarios([])))
+    parser.add_argument("--train-recs", action="store_true", help="train recommendations when seeding")
+    parser.add_argument("--seed", type=int, default=42, help="random seed for data and traffic")
+    parser.add_argument("--save", help="write the results as JSON here")
+    parser.add_argument("--compare", help="compare against results saved earlier with --save")
+    parser.add_argument("--threshold", type=float, default=0.10, help="regression tolerance for --compare")
+    args = parser.parse_args()
+
+    books = SCALES[args.scale]
+    config = {"JOBS_IN_PROCESS": False, "AVAILABILITY_RECONCILE_SECONDS": 0}
+    if args.database_url:
+        url = args.database_url
+        seed(create_app({**config, "SQLALCHEMY_DATABASE_URI": url}), books, args.train_recs, random.Random(args.seed))
+    else:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        seeded = os.path.join(DATA_DIR, f"seed-{args.scale}.db")
+        seed(create_app({**config, "SQLALCHEMY_DATABASE_URI": f"sqlite:///{seeded}"}), books, args.train_recs,
+             random.Random(args.seed))
+        working = os.path.join(DATA_DIR, "run.db")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(working + suffix):
+                os.remove(working + suffix)
+        shutil.copyfile(seeded, working)
+        url = f"sqlite:///{working}"
+
+    app = create_app({**config, "SQLALCHEMY_DATABASE_URI": url})
+    with app.app_context():
+        book_ids = db.session.execute(db.select(Book.id)).scalars().all()
+    routes = scenarios(book_ids)
+    selected = args.routes.split(",") if args.routes else list(routes)
+    clients = []
+    for n in range(args.users):
+        # One address per reader, as real clients would be, for the login limiter.
+        client = app.test_client()
+        client.environ_base["REMOTE_ADDR"] = f"10.0.{n // 256}.{n % 256}"
+        client.post("/login", data={"username": f"reader{n}", "password": PASSWORD})
+        client.get("/")  # take the login flash, which would bypass the page cache once
+        clients.append(client)
+
+    results = {"meta": {"scale": args.scale, "users": args.users, "seconds": args.seconds, "commit": git_commit(),
+                        "python": platform.python_version(), "database": url.split(":")[0],
+                        "date": datetime.now().isoformat(timespec="seconds")},
+               "routes": {}}
+    for i, route in enumerate(selected):
+        if args.warmup:
+            run_route(app, clients, routes[route], args.warmup, args.seed + i)
+        results["routes"][route] = run_route(app, clients, routes[route], args.seconds, args.seed + i)
+        print(f"{route}: {results['routes'][route]['p95_ms']:.1f} ms p95", file=sys.stderr)
+    results["consistency"] = check_consistency(app, args.users)
+    print_results(results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    status = 0
+    if results["consistency"]["oversold"] or not results["consistency"]["race"]["ok"]:
+        status = 1
+    if args.compare:
+        with open(args.compare) as f:
+            regressed = compare(results, json.load(f), args.threshold)
+        if regressed:
+            print(f"Regressed beyond {args.threshold:.0%}: {', '.join(regressed)}")
+            status = 1
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# covers.py
+# Book cover images. Uploaded originals are stored once under a content hash,
+# and the small thumbnails the catalog pages show are rendered from them on
+# demand (or ahead of time with `flask build-covers`). Nothing here knows
+# about Flask; Maktabty.py decides where the files live and serves them.
+import hashlib
+import io
+import os
+import tempfile
+
+from PIL import Image, ImageOps
+
+# Thumbnails are cropped to this width:height so pages can reserve their box.
+ASPECT = (2, 3)
+FORMATS = {"webp": "WEBP", "jpeg": "JPEG"}
+QUALITY = 80
+
+
+def save_original(stream, directory):
+    """Check that `stream` is an image and store it as <hash>.<format> in
+    `directory`. Returns the file name; uploading the same file twice stores
+    it once. Raises ValueError for anything Pillow cannot read."""
+    data = stream.read()
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.verify()
+            fmt = image.format.lower()
+    except Exception as exc:
+        raise ValueError("not an image") from exc
+    name = f"{hashlib.sha256(data).hexdigest()[:16]}.{fmt}"
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        _write_atomically(path, lambda f: f.write(data))
+    return name
+
+
+def thumbnail_size(width):
+    return width, width * ASPECT[1] // ASPECT[0]
+
+
+def render_thumbnail(original, target, width, fmt):
+    """Write a `width`-wide, ASPECT-cropped copy of `original` to `target`."""
+    with Image.open(original) as image:
+        image = ImageOps.exif_transpose(image)
+        image = ImageOps.fit(image.convert("RGB"), thumbnail_size(width), Image.LANCZOS)
+        _write_atomically(target, lambda f: image.save(f, FORMATS[fmt], quality=QUALITY, optimize=True))
+
+
+def _write_atomically(path, write):
+    # Concurrent requests for the same thumbnail may both render it; each
+    # writes a private temp file and the rename makes either one win whole.
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
@@ -0,0 +1,89 @@
+# loadtest_reserve.py
+# Load test for overselling: --threads readers all POST /reserve/<id> for the
+# same book at the same moment, and afterwards the book must have exactly
+# as many open bookings as it has copies, with Book.reserved agreeing.
+#
+#   python loadtest_reserve.py --threads 200 --copies 50
+#   python loadtest_reserve.py --database-url postgresql://... --rounds 5
+#
+# Exits with status 1 if any round oversold (or undersold). bench.py runs the
+# same race after its route phases.
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from Maktabty import Book, Booking, User, create_app, db, init_db
+
+
+def race(app, threads, copies):
+    """Add a book with `copies` copies and have `threads` readers, each on
+    its own thread and test client, try to reserve it at once. Returns the
+    outcome as a dict; "ok" is whether bookings == reserved == copies (or
+    == threads, when there are fewer readers than copies)."""
+    tag = uuid.uuid4().hex[:8]
+    with app.app_context():
+        book = Book(title=f"Load test {tag}", author="loadtest", copies=copies)
+        users = [User(username=f"loadtest-{tag}-{n}", password="-") for n in range(threads)]
+        db.session.add_all([book, *users])
+        db.session.commit()
+        book_id, user_ids = book.id, [u.id for u in users]
+
+    clients = []
+    for uid in user_ids:
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = uid
+        clients.append(client)
+    start = threading.Barrier(threads + 1)
+    errors = []
+
+    def reserve(client):
+        start.wait()
+        response = client.post(f"/reserve/{book_id}")
+        if response.status_code != 302:
+            errors.append(response.status_code)
+
+    workers = [threading.Thread(target=reserve, args=(client,)) for client in clients]
+    for worker in workers:
+        worker.start()
+    start.wait()
+    started = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        bookings = db.session.query(Booking).filter_by(book_id=book_id, status="Reserved").count()
+        reserved = db.session.get(Book, book_id).reserved
+    expected = min(copies, threads)
+    return {"threads": threads, "copies": copies, "bookings": bookings, "reserved": reserved,
+            "errors": len(errors), "reservations_per_second": round(threads / elapsed, 1),
+            "ok": bookings == reserved == expected and not errors}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Race concurrent reservations for one book.")
+    parser.add_argument("--database-url", help="database to test against (default: a new SQLite file)")
+    parser.add_argument("--threads", type=int, default=200, help="concurrent readers")
+    parser.add_argument("--copies", type=int, default=50, help="copies of the contended book")
+    parser.add_argument("--rounds", type=int, default=3, help="races to run, each on a new book")
+    args = parser.parse_args()
+
+    url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'loadtest.db')}"
+    app = create_app({"SQLALCHEMY_DATABASE_URI": url, "JOBS_IN_PROCESS": False})
+    with app.app_context():
+        init_db()
+    failed = 0
+    for _ in range(args.rounds):
+        result = race(app, args.threads, args.copies)
+        print(result)
+        failed += not result["ok"]
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
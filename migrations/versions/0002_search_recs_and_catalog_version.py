@@ -0,0 +1,62 @@
+"""Search index, recommendation tables and catalog version
+
+Everything added with db.create_all() before migrations existed, so the
+creates are no-ops on databases that already have these objects. Run
+`flask reindex-search` afterwards to fill book_fts for existing books.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 10:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_booking_user_date', 'booking', ['user_id', 'date'], unique=False, if_not_exists=True)
+    op.create_table('book_neighbor',
+    sa.Column('book_id', sa.Integer(), nullable=False),
+    sa.Column('neighbor_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['book_id'], ['book.id'], ),
+    sa.ForeignKeyConstraint(['neighbor_id'], ['book.id'], ),
+    sa.PrimaryKeyConstraint('book_id', 'neighbor_id'),
+    if_not_exists=True
+    )
+    op.create_table('book_cooccurrence',
+    sa.Column('book_id', sa.Integer(), nullable=False),
+    sa.Column('other_id', sa.Integer(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('book_id', 'other_id'),
+    if_not_exists=True
+    )
+    op.create_table('catalog_version',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    if_not_exists=True
+    )
+    op.execute("INSERT INTO catalog_version (id, version) "
+               "SELECT 1, 0 WHERE NOT EXISTS (SELECT 1 FROM catalog_version WHERE id = 1)")
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("CREATE TABLE IF NOT EXISTS book_fts (rowid INTEGER PRIMARY KEY, document TSVECTOR NOT NULL)")
+        op.execute("CREATE INDEX IF NOT EXISTS ix_book_fts_document ON book_fts USING GIN (document)")
+    else:
+        op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS book_fts "
+                   "USING fts5(title, author, tokenize='unicode61 remove_diacritics 2')")
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS book_fts")
+    op.drop_table('catalog_version')
+    op.drop_table('book_cooccurrence')
+    op.drop_table('book_neighbor')
+    op.drop_index('ix_booking_user_date', table_name='booking')
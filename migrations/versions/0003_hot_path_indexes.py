@@ -0,0 +1,26 @@
+"""Indexes for per-book booking lookups and title prefix browsing
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 10:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_booking_book_status', 'booking', ['book_id', 'status'], unique=False)
+    op.create_index('ix_book_title', 'book', ['title', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_book_title', table_name='book')
+    op.drop_index('ix_booking_book_status', table_name='booking')
@@ -0,0 +1,32 @@
+"""Count open reservations in book.reserved and keep book.copies as stock owned
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 11:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('book', sa.Column('reserved', sa.Integer(), server_default='0', nullable=False))
+    # Until now copies was decremented by each reservation and never given
+    # back, i.e. it held what was left on the shelf. Count the open bookings
+    # into reserved and add them back to copies to get the stock owned.
+    op.execute("UPDATE book SET reserved = (SELECT count(booking.id) FROM booking "
+               "WHERE booking.book_id = book.id AND booking.status = 'Reserved')")
+    op.execute("UPDATE book SET copies = copies + reserved WHERE copies IS NOT NULL")
+
+
+def downgrade():
+    op.execute("UPDATE book SET copies = copies - reserved WHERE copies IS NOT NULL")
+    with op.batch_alter_table('book') as batch_op:
+        batch_op.drop_column('reserved')
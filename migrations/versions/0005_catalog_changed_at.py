@@ -0,0 +1,26 @@
+"""Record when the catalog last changed, for Last-Modified
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17 13:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('catalog_version', sa.Column('changed_at', sa.DateTime(), nullable=True))
+    op.execute(sa.text("UPDATE catalog_version SET changed_at = CURRENT_TIMESTAMP"))
+
+
+def downgrade():
+    with op.batch_alter_table('catalog_version') as batch_op:
+        batch_op.drop_column('changed_at')
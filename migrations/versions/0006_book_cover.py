@@ -0,0 +1,25 @@
+"""Cover image per book
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17 14:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('book', sa.Column('image_filename', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('book') as batch_op:
+        batch_op.drop_column('image_filename')
@@ -0,0 +1,31 @@
+"""Server-side sessions
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-17 20:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('web_session',
+    sa.Column('id', sa.String(length=64), nullable=False),
+    sa.Column('data', sa.LargeBinary(), nullable=False),
+    sa.Column('expires', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_web_session_expires'), 'web_session', ['expires'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_web_session_expires'), table_name='web_session')
+    op.drop_table('web_session')
@@ -0,0 +1,104 @@
+# recommender.py
+# Offline training for the /recs page. Everything here works on plain ids and
+# strings so it can run from a CLI command or a worker without the Flask app;
+# Maktabty.py stores the resulting top-K neighbour lists in book_neighbor.
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+# Rows of the similarity matrix computed per step, to bound peak memory.
+CHUNK_ROWS = 1024
+
+
+def top_k(similarity, item_ids, k, offset=0):
+    """Yield (item_id, [(neighbour_id, score), ...]) for each row of a sparse
+    similarity block, best first, skipping the item itself."""
+    similarity = similarity.tocsr()
+    for row in range(similarity.shape[0]):
+        start, end = similarity.indptr[row], similarity.indptr[row + 1]
+        cols = similarity.indices[start:end]
+        scores = similarity.data[start:end]
+        keep = (cols != row + offset) & (scores > 0)
+        cols, scores = cols[keep], scores[keep]
+        if not len(cols):
+            continue
+        if len(cols) > k:
+            best = np.argpartition(-scores, k)[:k]
+            cols, scores = cols[best], scores[best]
+        order = np.argsort(-scores, kind="stable")
+        yield int(item_ids[row + offset]), [(int(item_ids[c]), float(s)) for c, s in zip(cols[order], scores[order])]
+
+
+def cosine_neighbours(vectors, item_ids, k):
+    """Top-k cosine neighbours for every row of `vectors` (items x features)."""
+    vectors = normalize(sparse.csr_matrix(vectors, dtype=np.float32))
+    transposed = vectors.T.tocsc()
+    for start in range(0, vectors.shape[0], CHUNK_ROWS):
+        block = vectors[start:start + CHUNK_ROWS] @ transposed
+        yield from top_k(block, item_ids, k, offset=start)
+
+
+def cooccurrence(bookings):
+    """Count, from (user_id, book_id) pairs, how many distinct readers booked
+    each pair of books. Returns (book ids, sparse books x books counts); the
+    diagonal holds each book's own reader count."""
+    users, items = {}, {}
+    rows, cols = [], []
+    for user_id, book_id in bookings:
+        rows.append(users.setdefault(user_id, len(users)))
+        cols.append(items.setdefault(book_id, len(items)))
+    item_ids = np.array(list(items), dtype=np.int64)
+    if not items:
+        return item_ids, sparse.csr_matrix((0, 0), dtype=np.float32)
+    matrix = sparse.coo_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)),
+                               shape=(len(users), len(items))).tocsr()
+    matrix.data[:] = 1  # repeat bookings of the same book count once
+    return item_ids, (matrix.T @ matrix).tocsr()
+
+
+def item_neighbours(item_ids, counts, k):
+    """Item-to-item neighbours from a cooccurrence() matrix: books are similar
+    when the same readers booked them, scored count(a, b) / sqrt(readers(a) *
+    readers(b)), i.e. cosine over the user-item matrix."""
+    scale = sparse.diags(1 / np.sqrt(counts.diagonal())).tocsr() if len(item_ids) else counts
+    neighbours = {}
+    for start in range(0, len(item_ids), CHUNK_ROWS):
+        block = scale[start:start + CHUNK_ROWS] @ counts @ scale
+        neighbours.update(top_k(block, item_ids, k, offset=start))
+    return neighbours
+
+
+def content_neighbours(books, k, analyzer=None):
+    """Neighbours by TF-IDF similarity of title and author, for books that have
+    little or no booking history. `books` yields (book_id, title, author)."""
+    ids, docs = [], []
+    for book_id, title, author in books:
+        ids.append(book_id)
+        docs.append(f"{title or ''} {author or ''}")
+    if len(ids) < 2:
+        return {}
+    vectorizer = TfidfVectorizer(analyzer=analyzer or "word", dtype=np.float32)
+    try:
+        tfidf = vectorizer.fit_transform(docs)
+    except ValueError:  # no usable terms at all
+        return {}
+    return dict(cosine_neighbours(tfidf, np.array(ids, dtype=np.int64), k))
+
+
+def merge_neighbours(collaborative, content, k, content_weight=0.5):
+    """Top-k table per book: booking-based neighbours first, topped up with
+    down-weighted content neighbours where history is too thin."""
+    merged = {}
+    for book_id in collaborative.keys() | content.keys():
+        neighbours = list(collaborative.get(book_id, ()))[:k]
+        seen = {n for n, _ in neighbours}
+        for neighbour, score in content.get(book_id, ()):
+            if len(neighbours) >= k:
+                break
+            if neighbour not in seen:
+                neighbours.append((neighbour, score * content_weight))
+                seen.add(neighbour)
+        merged[book_id] = neighbours
+    return merged
+